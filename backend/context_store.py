@@ -0,0 +1,235 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Segment record: key length, value length, key bytes, value bytes
+RECORD_HEADER = struct.Struct('>II')
+
+class TieredContextStore:
+    """
+    Context histories split between a hot in-memory tier and a cold on-disk tier.
+
+    Hot contexts live in an LRU bounded by a byte budget. When the budget is
+    exceeded, the least recently used contexts are appended to a segment file
+    and only their (offset, length) stays in memory. Cold contexts are read
+    back through an mmap of the segment and promoted to the hot tier when
+    they are accessed again. Superseded records are reclaimed by compacting
+    the segment once they make up most of it.
+
+    A segment_path given by the caller outlives the store: every update is
+    written through to it and an existing segment is indexed on open, so a
+    server that crashed or was killed restarts with the contexts it had.
+    Hot contexts whose value is already in the segment are not rewritten when
+    they are evicted.
+    """
+
+    def __init__(self, budget_bytes: int = 64 * 1024 * 1024, segment_path: Optional[str] = None):
+        self.budget_bytes = budget_bytes
+        self.hot: "OrderedDict[str, str]" = OrderedDict()
+        self.hot_bytes = 0 # UTF-8 size of the hot values, kept under budget_bytes
+        self.value_sizes: Dict[str, int] = {} # context_id -> UTF-8 size of its value, hot or cold
+        self.cold: Dict[str, Tuple[int, int]] = {} # context_id -> (value offset, value length)
+        self.flushed: Dict[str, Tuple[int, int]] = {} # hot context_id -> location of its current value in the segment
+        self.live_bytes = 0 # segment bytes still referenced by the cold and flushed indexes
+        self.lock = threading.RLock()
+
+        self.owns_segment = segment_path is None
+        if segment_path is None:
+            fd, segment_path = tempfile.mkstemp(prefix="contexts-", suffix=".seg")
+            os.close(fd)
+        self.segment_path = segment_path
+        self.segment = open(segment_path, "r+b" if os.path.exists(segment_path) else "w+b")
+        self.map: Optional[mmap.mmap] = None
+        self._recover()
+
+    def _recover(self) -> None:
+        """Rebuild the cold index from the records of an existing segment."""
+        self._remap()
+        size = len(self.map) if self.map is not None else 0
+        position = 0
+        while position + RECORD_HEADER.size <= size:
+            key_length, value_length = RECORD_HEADER.unpack_from(self.map, position)
+            key_start = position + RECORD_HEADER.size
+            end = key_start + key_length + value_length
+            if end > size:
+                break
+            context_id = self.map[key_start:key_start + key_length].decode('utf-8')
+            self._drop_record(context_id)
+            self.cold[context_id] = (key_start + key_length, value_length)
+            self.value_sizes[context_id] = value_length
+            self.live_bytes += end - position
+            position = end
+        if position < size:
+            # A record torn by a crash mid-write, drop it
+            self.map.close()
+            self.map = None
+            self.segment.truncate(position)
+        self.segment.seek(position)
+
+    def _remap(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.segment.flush()
+        if os.fstat(self.segment.fileno()).st_size:
+            self.map = mmap.mmap(self.segment.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read(self, location: Tuple[int, int]) -> str:
+        offset, length = location
+        if self.map is None or offset + length > len(self.map):
+            self._remap()
+        return self.map[offset:offset + length].decode('utf-8')
+
+    def _read_cold(self, context_id: str) -> str:
+        return self._read(self.cold[context_id])
+
+    def _append(self, records, index: Dict[str, Tuple[int, int]]) -> None:
+        """Write records to the end of the segment and file their locations in index."""
+        self.segment.seek(0, os.SEEK_END)
+        for context_id, value in records:
+            key = context_id.encode('utf-8')
+            data = value.encode('utf-8')
+            offset = self.segment.tell() + RECORD_HEADER.size + len(key)
+            self.segment.write(RECORD_HEADER.pack(len(key), len(data)) + key + data)
+            self._drop_record(context_id)
+            index[context_id] = (offset, len(data))
+            self.live_bytes += RECORD_HEADER.size + len(key) + len(data)
+        self.segment.flush()
+
+    def _drop_record(self, context_id: str) -> None:
+        """Forget the segment record of a context, whichever tier it is in."""
+        location = self.cold.pop(context_id, None) or self.flushed.pop(context_id, None)
+        if location is not None:
+            self.live_bytes -= RECORD_HEADER.size + len(context_id.encode('utf-8')) + location[1]
+
+    def _promote(self, context_id: str, value: str) -> None:
+        """Move a cold context to the hot tier, its record stays valid."""
+        self.flushed[context_id] = self.cold.pop(context_id)
+        self.hot[context_id] = value
+        self.hot_bytes += self.value_sizes[context_id]
+
+    def _evict(self) -> None:
+        evicted = []
+        while self.hot_bytes > self.budget_bytes and len(self.hot) > 1:
+            context_id, value = self.hot.popitem(last=False)
+            self.hot_bytes -= self.value_sizes[context_id]
+            if context_id in self.flushed:
+                self.cold[context_id] = self.flushed.pop(context_id)
+            else:
+                evicted.append((context_id, value))
+        if evicted:
+            self._append(evicted, self.cold)
+        self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        segment_bytes = self.segment.tell()
+        if segment_bytes < 1024 * 1024 or self.live_bytes * 2 > segment_bytes:
+            return
+        cold = [(context_id, self._read(location)) for context_id, location in self.cold.items()]
+        flushed = [(context_id, self._read(location)) for context_id, location in self.flushed.items()]
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.segment.seek(0)
+        self.segment.truncate()
+        self.cold.clear()
+        self.flushed.clear()
+        self.live_bytes = 0
+        self._append(cold, self.cold)
+        self._append(flushed, self.flushed)
+
+    def __contains__(self, context_id: str) -> bool:
+        with self.lock:
+            return context_id in self.hot or context_id in self.cold
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.hot) + len(self.cold)
+
+    def get(self, context_id: str, default: Optional[str] = None) -> Optional[str]:
+        """Return a context, promoting it to the hot tier if it was cold."""
+        with self.lock:
+            if context_id in self.hot:
+                self.hot.move_to_end(context_id)
+                return self.hot[context_id]
+            if context_id not in self.cold:
+                return default
+            value = self._read_cold(context_id)
+            self._promote(context_id, value)
+            self._evict()
+            return value
+
+    def peek(self, context_id: str) -> Optional[str]:
+        """Return a context without changing its tier or recency."""
+        with self.lock:
+            if context_id in self.hot:
+                return self.hot[context_id]
+            if context_id in self.cold:
+                return self._read_cold(context_id)
+            return None
+
+    def __getitem__(self, context_id: str) -> str:
+        value = self.get(context_id)
+        if value is None:
+            raise KeyError(context_id)
+        return value
+
+    def __setitem__(self, context_id: str, value: str) -> None:
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            if context_id in self.hot:
+                self.hot_bytes -= self.value_sizes[context_id]
+            if self.owns_segment:
+                self._drop_record(context_id)
+            else:
+                # Write through, so the update survives a crash
+                self._append([(context_id, value)], self.flushed)
+            self.hot[context_id] = value
+            self.hot.move_to_end(context_id)
+            self.value_sizes[context_id] = size
+            self.hot_bytes += size
+            self._evict()
+
+    def sizes(self) -> Dict[str, int]:
+        """UTF-8 size of every context, without reading any of them."""
+        with self.lock:
+            return dict(self.value_sizes)
+
+    def items(self) -> List[Tuple[str, str]]:
+        """All contexts; cold ones are read without being promoted."""
+        with self.lock:
+            return [(context_id, self.peek(context_id)) for context_id in list(self.hot) + list(self.cold)]
+
+    def copy(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.items())
+
+    def preload(self) -> int:
+        """
+        Promote recovered cold contexts into the hot tier, most recently
+        written first, as long as they fit the budget. Returns how many.
+        """
+        with self.lock:
+            loaded = 0
+            for context_id, (_, length) in sorted(self.cold.items(), key=lambda item: item[1][0], reverse=True):
+                if self.hot_bytes + length > self.budget_bytes:
+                    break
+                self._promote(context_id, self._read_cold(context_id))
+                self.hot.move_to_end(context_id, last=False)
+                loaded += 1
+            return loaded
+
+    def close(self) -> None:
+        with self.lock:
+            if self.segment.closed:
+                return
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.segment.close()
+            if self.owns_segment:
+                os.remove(self.segment_path)
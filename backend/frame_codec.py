@@ -0,0 +1,170 @@
+import threading
+import time
+import struct
+import zlib
+import collections
+
+COMPRESSED_FLAG = 0x80000000 # high bit of the length prefix marks a compressed frame
+CODEC_NAME = "zlib"
+
+# Representative prompt/answer text and frame skeletons, in the shape
+# ProcessServer.encode_message produces them. build_dictionary() turns it
+# into a zlib preset dictionary so even the first few hundred bytes of a
+# frame compress well.
+TRAINING_SAMPLES = [
+  '{"header": "ACCEPT", "message": "#rid=0.1a2b3c:2,deadline=1700000000.000 query 1 ", "ballot_number": [1, 0, 0], "src": 0, "context_id": -1, "commit_index": 12, "commits": [[13, "#rid=0.1a2b3c:1 create 1"]], "dest": 1}',
+  '{"header": "ACCEPTED", "message": "#rid=1.4d5e6f:3 create 2", "ballot_number": [1, 0, 0], "src": 1, "context_id": -1, "commit_index": 12, "dest": 0}',
+  '{"header": "DECIDE", "message": "#rid=2.7a8b9c:4 query 2 ", "ballot_number": [1, 0, 0], "src": 0, "context_id": -1, "commit_index": 12, "commits": [[14, "#rid=2.7a8b9c:4 query 2 "]], "dest": 2}',
+  '{"header": "FORWARD", "message": "#rid=1.4d5e6f:5 choose 1 2 0123456789abcdef", "ballot_number": [1, 1, 0], "src": 1, "context_id": -1, "commit_index": 12, "chosen": ["1", 2, "0123456789abcdef", ""], "dest": 0}',
+  '{"header": "ACCEPT", "message": "#rid=1.4d5e6f:5 choose 1 2 0123456789abcdef", "ballot_number": [1, 0, 0], "src": 0, "context_id": -1, "commit_index": 12, "commits": [[15, "#rid=0.1a2b3c:2,deadline=1700000000.000 query 1 "]], "dest": 2}',
+  '{"header": "RESPONSE", "message": "", "ballot_number": [1, 0, 0], "src": 2, "context_id": "1", "commit_index": 12, "dest": 0}',
+  '{"header": "BLOB", "message": "", "ballot_number": [1, 0, 0], "src": 2, "context_id": "1", "commit_index": 12, "blob": [2, "0123456789abcdef"], "dest": 1}',
+  "Query: What is the difference between \\nAnswer: The main difference is that ",
+  "Query: Can you explain how \\nAnswer: Sure! Here is an explanation of how it works:\\n\\n* **",
+  "Query: Why does \\nAnswer: There are several reasons for this. First, the ",
+  "\\nAnswer: In summary, this means that the answer depends on the context and the specific ",
+  " of the, and the, in the, to the, that is, for example, however, because, which is, it is important to note that ",
+]
+
+def build_dictionary(samples, size=16384):
+  """
+  Build a zlib preset dictionary from sample payloads. Substrings shared by
+  many samples are kept and placed towards the end, where zlib can reach
+  them with the shortest distances.
+  """
+  counts = collections.Counter()
+  for sample in samples:
+    for length in (32, 16, 8):
+      for start in range(0, max(len(sample) - length, 0) + 1, length // 2):
+        counts[sample[start:start + length]] += 1
+
+  dictionary = bytearray()
+  for chunk, _ in reversed(counts.most_common()):
+    encoded = chunk.encode('utf-8')
+    if encoded in dictionary:
+      continue
+    dictionary.extend(encoded)
+  for sample in samples:
+    dictionary.extend(sample.encode('utf-8'))
+  return bytes(dictionary[-size:])
+
+DEFAULT_DICTIONARY = build_dictionary(TRAINING_SAMPLES)
+DEFAULT_DICTIONARY_ID = zlib.crc32(DEFAULT_DICTIONARY)
+
+def parse_prefix(raw_length):
+  """Return (payload length, compressed flag) for a 4 byte frame prefix."""
+  value = struct.unpack('>I', raw_length)[0]
+  return value & ~COMPRESSED_FLAG, bool(value & COMPRESSED_FLAG)
+
+def offer():
+  """Codec capabilities advertised in a HELLO message."""
+  return {CODEC_NAME: DEFAULT_DICTIONARY_ID}
+
+class SharedPayload:
+  """
+  Frame bytes shared by every destination of a broadcast. The first codec
+  that compresses it keeps the compressor state after this prefix, so other
+  destinations only compress their own tail from a copy of that state.
+  """
+
+  def __init__(self, data):
+    self.data = data
+    self.lock = threading.Lock()
+    self.compressed = {} # (level, dictionary) -> (compressed prefix, compressor after the prefix)
+
+  def __len__(self):
+    return len(self.data)
+
+  def __bytes__(self):
+    return self.data
+
+  def compress(self, level, dictionary):
+    """Return the compressed prefix and a private compressor to continue the stream, and whether it was reused."""
+    key = (level, dictionary is not None)
+    with self.lock:
+      reused = key in self.compressed
+      if not reused:
+        compressor = zlib.compressobj(level, zdict=dictionary) if dictionary else zlib.compressobj(level)
+        self.compressed[key] = (compressor.compress(self.data), compressor)
+      prefix, compressor = self.compressed[key]
+      return prefix, compressor.copy(), reused
+
+class FrameCodec:
+  """
+  Per-connection frame compression. Every frame carries its own compressed
+  flag, so a receiver can always decode; enable() is only called once the
+  peer has advertised support in its HELLO. Frames under the threshold, or
+  that do not shrink by at least min_saving, are sent as is.
+  """
+
+  def __init__(self, threshold=1024, min_saving=0.1, level=6):
+    self.threshold = threshold
+    self.min_saving = min_saving
+    self.level = level
+    self.enabled = False
+    self.dictionary = None
+    self.stats_lock = threading.Lock()
+    self.counters = collections.Counter()
+
+  def enable(self, peer_codecs):
+    """Turn on compression if the peer's HELLO lists a codec we share."""
+    if CODEC_NAME not in peer_codecs:
+      return False
+    # Only use the preset dictionary if both sides trained the same one
+    self.dictionary = DEFAULT_DICTIONARY if peer_codecs[CODEC_NAME] == DEFAULT_DICTIONARY_ID else None
+    self.enabled = True
+    return True
+
+  def count(self, **amounts):
+    with self.stats_lock:
+      self.counters.update(amounts)
+
+  def encode(self, parts):
+    """
+    Return the buffers of a length-prefixed frame holding the given parts.
+    A leading SharedPayload is compressed once across all the frames it is
+    part of, only the remaining parts are compressed per frame.
+    """
+    size = sum(len(part) for part in parts)
+    plain = [bytes(part) if isinstance(part, SharedPayload) else part for part in parts]
+    if not self.enabled or size < self.threshold:
+      self.count(frames=1, skipped_small=1 if self.enabled else 0, bytes_in=size, bytes_out=size)
+      return [struct.pack('>I', size), *plain]
+
+    start = time.thread_time()
+    chunks = []
+    if isinstance(parts[0], SharedPayload):
+      prefix, compressor, reused = parts[0].compress(self.level, self.dictionary)
+      chunks.append(prefix)
+      parts = parts[1:]
+      self.count(shared_reused=1 if reused else 0)
+    else:
+      compressor = zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary else zlib.compressobj(self.level)
+    compressed = b"".join(chunks + [compressor.compress(part) for part in parts] + [compressor.flush()])
+    elapsed = time.thread_time() - start
+
+    if len(compressed) > size * (1 - self.min_saving):
+      self.count(frames=1, skipped_incompressible=1, bytes_in=size, bytes_out=size, compress_us=int(elapsed * 1e6))
+      return [struct.pack('>I', size), *plain]
+
+    self.count(frames=1, compressed=1, bytes_in=size, bytes_out=len(compressed), compress_us=int(elapsed * 1e6))
+    return [struct.pack('>I', len(compressed) | COMPRESSED_FLAG), compressed]
+
+  def decode(self, payload, compressed):
+    if not compressed:
+      return payload
+    start = time.thread_time()
+    # Always offer the preset dictionary: zlib only uses it for streams that
+    # were compressed with it, so frames from a peer whose HELLO we have not
+    # processed yet still decode
+    decompressor = zlib.decompressobj(zdict=DEFAULT_DICTIONARY)
+    data = decompressor.decompress(payload) + decompressor.flush()
+    self.count(frames_decompressed=1, decompress_us=int((time.thread_time() - start) * 1e6))
+    return data
+
+  def stats(self):
+    with self.stats_lock:
+      stats = dict(self.counters)
+    bytes_in = stats.get("bytes_in", 0)
+    stats["ratio"] = round(bytes_in / stats["bytes_out"], 2) if stats.get("bytes_out") else 1.0
+    return stats
@@ -1,18 +1,72 @@
+import logging
+import random
 import threading
-import google.generativeai as genai
-from typing import Dict, Optional
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+from context_store import TieredContextStore
+
+MODEL_NAME = "gemini-1.5-flash"
+
+def transient_errors() -> tuple:
+    """Upstream errors worth retrying with backoff."""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.InternalServerError,
+        ConnectionError,
+        TimeoutError,
+    )
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of samples."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
 
 class LLMService:
-    def __init__(self, api_key: str):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel("gemini-1.5-flash")
-        self.contexts: Dict[str, str] = {}
+    def __init__(self, api_key: str, context_budget_bytes: int = 64 * 1024 * 1024, segment_path: Optional[str] = None,
+                 default_timeout: float = 60.0, hedge_percentile: float = 95.0, hedge_min_delay: float = 1.0,
+                 hedge_initial_delay: float = 5.0, max_retries: int = 3, backoff_base: float = 0.5):
+        # The Gemini client is slow to import and build, it is only loaded on
+        # first use or by warmup() once the server has joined consensus
+        self.api_key = api_key
+        self.model = None
+        self.model_lock = threading.Lock()
+        self.transient_errors: tuple = (ConnectionError, TimeoutError)
+        # Recently used contexts stay in memory, idle ones are paged out to disk
+        self.contexts = TieredContextStore(context_budget_bytes, segment_path)
         self.contexts_lock = threading.Lock()
+        # Set once the store is closed; threads still deciding then see
+        # every context operation fail instead of touching a closed file
+        self.closed = False
+
+        # A call still running after the hedge_percentile latency of recent
+        # calls gets a second, hedged request; whichever finishes first wins
+        self.default_timeout = default_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_initial_delay = hedge_initial_delay
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+        self.metrics_lock = threading.Lock()
+        self.latencies: deque = deque(maxlen=512) # completed calls, as seen by the caller
+        self.primary_latencies: deque = deque(maxlen=512) # first attempts, including ones that lost a hedge
+        self.counters: Dict[str, int] = {"requests": 0, "hedged": 0, "hedge_wins": 0, "retries": 0, "failures": 0}
+        # Wall clock used for deadlines, replaced by a virtual one in simulation
+        self.clock = time.time
+        self.sleep = time.sleep
         
     def create_context(self, context_id: str) -> bool:
         """Create a new empty context."""
         with self.contexts_lock:
-            if context_id in self.contexts:
+            if self.closed or context_id in self.contexts:
                 return False
             self.contexts[context_id] = ""
             return True
@@ -20,28 +74,126 @@ class LLMService:
     def add_query_to_context(self, context_id: str, query: str) -> bool:
         """Add a query to a context without generating response."""
         with self.contexts_lock:
-            if context_id not in self.contexts:
+            if self.closed or context_id not in self.contexts:
                 return False
                 
-            if self.contexts[context_id]:
-                self.contexts[context_id] += "\n"
-            self.contexts[context_id] += f"Query: {query}"
+            context = self.contexts[context_id]
+            if context:
+                context += "\n"
+            self.contexts[context_id] = context + f"Query: {query}"
             return True
             
-    def generate_response(self, context_id: str) -> Optional[str]:
-        """Generate LLM response for the current context."""
+    def generate_response(self, context_id: str, deadline: Optional[float] = None) -> Optional[str]:
+        """
+        Generate LLM response for the current context.
+
+        deadline is an absolute time.time() value, None means default_timeout
+        from now. Returns None if the context does not exist or no response
+        could be produced before the deadline.
+        """
         with self.contexts_lock:
-            if context_id not in self.contexts:
+            if self.closed or context_id not in self.contexts:
                 return None
-            
             prompt = self.contexts[context_id] + "\nAnswer: "
-            response = self.model.generate_content(prompt)
-            return response.text
+            
+        # The model is called outside the lock so a slow generation does not
+        # hold up every other context operation
+        if deadline is None:
+            deadline = self.clock() + self.default_timeout
+        self.count("requests")
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+            try:
+                return self.hedged_call(prompt, remaining)
+            except self.transient_errors:
+                if attempt == self.max_retries:
+                    break
+                self.count("retries")
+                backoff = self.backoff_base * (2 ** attempt) * random.uniform(0.5, 1.5)
+                self.sleep(min(backoff, max(0.0, deadline - self.clock())))
+            except Exception as e:
+                # Anything else (bad request, blocked prompt, ...) will not
+                # succeed on a retry, it counts as a failed attempt
+                logging.error(f"LLM call for context {context_id} failed: {e!r}")
+                break
+        self.count("failures")
+        return None
+
+    def load_model(self):
+        """Import, configure and build the Gemini client on first use."""
+        with self.model_lock:
+            if self.model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self.transient_errors = transient_errors()
+                self.model = genai.GenerativeModel(MODEL_NAME)
+            return self.model
+
+    def warmup(self) -> Future:
+        """
+        Load the model client and preload recovered contexts into memory in
+        the background. The returned future yields the number preloaded.
+        """
+        def run() -> int:
+            self.load_model()
+            with self.contexts_lock:
+                return 0 if self.closed else self.contexts.preload()
+        return self.executor.submit(run)
+
+    def call_model(self, prompt: str, timeout: float) -> str:
+        response = self.load_model().generate_content(prompt, request_options={"timeout": timeout})
+        return response.text
+
+    def hedge_delay(self) -> float:
+        with self.metrics_lock:
+            samples = list(self.latencies)
+        if len(samples) < 20:
+            return self.hedge_initial_delay
+        return max(self.hedge_min_delay, percentile(samples, self.hedge_percentile))
+
+    def hedged_call(self, prompt: str, timeout: float) -> str:
+        """
+        Run one model call, adding a hedged duplicate if it takes longer than
+        the hedge delay. The first successful result is returned and the other
+        call is cancelled; if it already started, its own timeout bounds it
+        and its result is discarded.
+        """
+        start = time.monotonic()
+        primary = self.executor.submit(self.call_model, prompt, timeout)
+        primary.add_done_callback(lambda _: self.record(self.primary_latencies, time.monotonic() - start))
+        futures = {primary}
+
+        delay = self.hedge_delay()
+        if delay < timeout and not wait(futures, timeout=delay).done:
+            self.count("hedged")
+            futures.add(self.executor.submit(self.call_model, prompt, timeout - delay))
+
+        error = None
+        while futures:
+            remaining = timeout - (time.monotonic() - start)
+            done, futures = wait(futures, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    for loser in futures:
+                        loser.cancel()
+                    if future is not primary:
+                        self.count("hedge_wins")
+                    self.record(self.latencies, time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+
+        for loser in futures:
+            loser.cancel()
+        raise error or TimeoutError("LLM call did not finish before the deadline")
         
     def save_answer(self, context_id: str, answer: str) -> bool:
         """Save a selected answer to the context."""
         with self.contexts_lock:
-            if context_id not in self.contexts:
+            if self.closed or context_id not in self.contexts:
                 return False
                 
             self.contexts[context_id] += f"\nAnswer: {answer}"
@@ -50,19 +202,73 @@ class LLMService:
     def get_context(self, context_id: str) -> Optional[str]:
         """Retrieve a specific context."""
         with self.contexts_lock:
-            return self.contexts.get(context_id)
+            return None if self.closed else self.contexts.get(context_id)
         
     def get_all_contexts(self) -> Dict[str, str]:
         """Retrieve all contexts."""
         with self.contexts_lock:
-            return self.contexts.copy()
+            return {} if self.closed else self.contexts.copy()
+        
+    def get_context_sizes(self) -> Dict[str, int]:
+        """Size in bytes of every context, cheap enough to send with each message."""
+        with self.contexts_lock:
+            return {} if self.closed else self.contexts.sizes()
+
+    def get_contexts(self, context_ids: List[str]) -> Dict[str, str]:
+        """Retrieve the given contexts, skipping unknown ones, without promoting cold ones."""
+        with self.contexts_lock:
+            if self.closed:
+                return {}
+            return {context_id: self.contexts.peek(context_id) for context_id in context_ids if context_id in self.contexts}
         
+    def restore_contexts(self, contexts: Dict[str, str]) -> None:
+        """Overwrite the given contexts with the values from a peer's snapshot."""
+        with self.contexts_lock:
+            if self.closed:
+                return
+            for context_id, content in contexts.items():
+                self.contexts[context_id] = content
+
     def compare_and_update_dict(self, other_dict: Dict[str, str]) -> None:
         """
         Compare received dictionary with local one and update if behind.
         """
         with self.contexts_lock:
-            # Update any missing or outdated contexts
+            if self.closed:
+                return
+            # Update any missing or outdated contexts, peeking so that comparing
+            # does not pull every cold context back into memory
             for context_id, content in other_dict.items():
-                if context_id not in self.contexts or len(self.contexts[context_id]) < len(content):
-                    self.contexts[context_id] = content
\ No newline at end of file
+                local = self.contexts.peek(context_id)
+                if local is None or len(local) < len(content):
+                    self.contexts[context_id] = content
+
+    def count(self, counter: str) -> None:
+        with self.metrics_lock:
+            self.counters[counter] += 1
+
+    def record(self, samples: deque, latency: float) -> None:
+        with self.metrics_lock:
+            samples.append(latency)
+
+    def get_metrics(self) -> Dict[str, Optional[float]]:
+        """Hedge rate and latency percentiles of recent LLM calls."""
+        with self.metrics_lock:
+            metrics: Dict[str, Optional[float]] = dict(self.counters)
+            latencies = list(self.latencies)
+            primary_latencies = list(self.primary_latencies)
+        metrics["hedge_rate"] = round(metrics["hedged"] / metrics["requests"], 3) if metrics["requests"] else 0.0
+        metrics["p50"] = percentile(latencies, 50)
+        metrics["p99"] = percentile(latencies, 99)
+        # First attempts on their own approximate the latency without hedging
+        metrics["p99_unhedged"] = percentile(primary_latencies, 99)
+        if metrics["p99"] is not None and metrics["p99_unhedged"] is not None:
+            metrics["p99_improvement"] = round(metrics["p99_unhedged"] - metrics["p99"], 3)
+        return metrics
+
+    def close(self) -> None:
+        """Release the on-disk context segment and the model call pool."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.contexts_lock:
+            self.closed = True
+            self.contexts.close()
@@ -4,7 +4,10 @@ import time
 import logging
 import sys
 import json
-import struct
+import frame_codec
+from frame_codec import FrameCodec
+from outbound import OutboundQueue
+from scenario_runner import ScenarioRunner
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -22,10 +25,15 @@ class NetworkServer:
     self.connection_map = [[False for _ in range(num_servers)] for _ in range(num_servers)]
     self.server_port = base_port
     self.cur_leader = 0
+    self.delay = 3 # seconds each forwarded message is held back, emulating a slow link
     self.server_socket = None
     self.is_running = True
     self.connection_lock = threading.Lock()
     self.connections = {} # keep track of all TCP connections, node_num --> socket
+    self.outbound = {} # node_num --> OutboundQueue writing to that node's socket
+    self.codecs = {} # node_num --> FrameCodec negotiated with that node
+    self.observers = [] # callables notified with (server_id, message) for every message received
+    self.direct_nodes = set() # nodes whose Paxos traffic bypasses the relay over the peer mesh
     logging.info("Successfully initialized network server")
   
   def get_server_id(self, addr):
@@ -73,15 +81,21 @@ class NetworkServer:
 
         self.add_connections(server_id)
         self.connections[server_id] = client_socket
+        if server_id in self.outbound:
+          self.outbound[server_id].close(timeout=0)
+        self.codecs[server_id] = FrameCodec()
+        self.outbound[server_id] = OutboundQueue(client_socket, name=f"server {server_id}", codec=self.codecs[server_id])
         logging.debug(f"updating connections dictionary: {self.connections}")
-        handler_thread = threading.Thread(target=self.handle_process, args=(client_socket,), daemon=True)
+        self.broadcast_links()
+        handler_thread = threading.Thread(target=self.handle_process, args=(client_socket, server_id,), daemon=True)
         handler_thread.start()
       except Exception as e:
         if self.is_running:
           logging.exception(f"Error accepting connections: {e}")
 
-  def handle_process(self, p_socket):
+  def handle_process(self, p_socket, server_id):
     logging.debug("Handling the process in a new thread")
+    codec = self.codecs[server_id]
     try:
       while self.is_running:
         # Read exactly 4 bytes for the length prefix
@@ -89,17 +103,22 @@ class NetworkServer:
         if not raw_length:
           break  # Connection closed or error
 
-        # Unpack the length (big-endian unsigned integer)
-        message_length = struct.unpack('>I', raw_length)[0]
+        # Unpack the length (big-endian unsigned integer) and compressed flag
+        message_length, compressed = frame_codec.parse_prefix(raw_length)
 
         # Read the message data based on the length
         message_bytes = self.recvall(p_socket, message_length)
         if not message_bytes:
           break  # Connection closed or error
 
-        # Decode and deserialize the JSON message
-        message_str = message_bytes.decode('utf-8')
+        # Decompress, decode and deserialize the JSON message
+        message_str = codec.decode(message_bytes, compressed).decode('utf-8')
         message = json.loads(message_str)
+        if message["header"] == "HELLO":
+          self.negotiate(server_id, message)
+          continue
+        for observer in list(self.observers):
+          observer(server_id, message)
         forward_thread = threading.Thread(target=self.forward_message, args=(message,))
         forward_thread.start()
     except Exception as e:
@@ -107,6 +126,53 @@ class NetworkServer:
     finally:
       p_socket.close()
     
+  def negotiate(self, server_id, hello):
+    """
+    Agree on frame compression with a newly connected process. The reply
+    goes out immediately rather than through the delayed forwarding path.
+    """
+    # Queue the reply before enabling compression, so the process has our
+    # HELLO before any compressed frame forwarded to it
+    self.send_control(server_id, "HELLO", codecs=frame_codec.offer())
+    enabled = self.codecs[server_id].enable(hello.get("codecs", {}))
+    logging.info(f"Compression with server {server_id}: {'on' if enabled else 'off'}")
+    if hello.get("direct"):
+      self.direct_nodes.add(server_id)
+    else:
+      self.direct_nodes.discard(server_id)
+
+  def send_control(self, dest_id, header, content="", **extra):
+    """Send a message from the NetworkServer itself, skipping the forwarding delay."""
+    if dest_id not in self.outbound:
+      logging.error(f"Could not connect to server: {dest_id}")
+      return False
+    message = {
+      "header" : header,
+      "message" : content,
+      "ballot_number" : (-1, -1, -1),
+      "dest" : dest_id,
+      "src" : -1,
+      "context_id" : -1,
+      "contexts": {},
+      **extra
+    }
+    self.outbound[dest_id].send(dest_id, json.dumps(message).encode('utf-8'))
+    return True
+
+  def broadcast_links(self):
+    """
+    Tell every connected node which of its links are up and the forwarding
+    delay, so nodes talking to each other directly apply the same rules.
+    """
+    with self.connection_lock:
+      rows = {server_id: list(self.connection_map[server_id]) for server_id in list(self.outbound)}
+    for server_id, links in rows.items():
+      self.send_control(server_id, "LINKSTATE", links=links, delay=self.delay)
+
+  def can_forward(self, src_id, dest_id):
+    """Messages from the NetworkServer itself always go through, others need a working link."""
+    return src_id == -1 or self.connection_map[src_id][dest_id]
+
   # demo function, logic needs to be updated to handle multi-paxos protocol
   def forward_message(self, json_message):
     try:
@@ -114,23 +180,19 @@ class NetworkServer:
       src_id = json_message["src"]
       dest_id = json_message["dest"]
       
-      if dest_id not in self.connections:
+      if dest_id not in self.outbound:
         logging.error(f"Could not connect to server: {dest_id}")
         return 
 
-      dest_sock = self.connections[dest_id]
+      dest_queue = self.outbound[dest_id]
 
-      if self.connection_map[src_id][dest_id] or src_id == -1:
-        time.sleep(3)
+      if self.can_forward(src_id, dest_id):
+        time.sleep(self.delay)
         # Convert message to JSON string and encode to bytes
         dest_msg = json.dumps(json_message).encode('utf-8')
         
-        # Calculate message length and create length prefix
-        message_length = len(dest_msg)
-        length_prefix = struct.pack('>I', message_length)
-        
-        # Send length prefix followed by message
-        dest_sock.sendall(length_prefix + dest_msg)
+        # Queue the frame, the destination's writer thread adds the length prefix
+        dest_queue.send(dest_id, dest_msg)
         logging.info(f"Sent message: {json_message['header']} from server {src_id if int(src_id) != -1 else 'Network Server'} to server {dest_id}")
       else:
           logging.error(f"Failed to send message from {src_id} to {dest_id}")
@@ -145,6 +207,7 @@ class NetworkServer:
       sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       sock.connect(('localhost', port))
       self.connections[server_id] = sock
+      self.outbound[server_id] = OutboundQueue(sock, name=f"server {server_id}")
       logging.info(f"Connected to server {server_id} on port {port}")
     except Exception as e:
       logging.exception(f"Failed to connect to server {server_id} on port {port}: {e}")
@@ -167,10 +230,23 @@ class NetworkServer:
           dest = int(tokens[2])
           self.fixLink(src, dest)
           logging.info(f"Link between {src} and {dest} fixed")
+        elif command == "delay" and len(tokens) == 2:
+          self.delay = float(tokens[1])
+          self.broadcast_links()
+          logging.info(f"Forwarding delay set to {self.delay}s")
         elif command == "failNode" and len(tokens) == 2:
           node_num = int(tokens[1])
           self.failNode(node_num)
           logging.info(f"Node {node_num} failed")
+        elif command == "runScenario" and len(tokens) == 2:
+          if self.direct_nodes:
+            # The runner measures the cluster from the traffic it relays
+            logging.warning(f"Servers {sorted(self.direct_nodes)} use --direct, their traffic bypasses the relay and a scenario could not observe it")
+          else:
+            ScenarioRunner(self, tokens[1]).start()
+        elif command == "stats" and len(tokens) == 1:
+          for server_id, codec in sorted(self.codecs.items()):
+            print(f"Server {server_id} compression: {codec.stats()}")
         elif command == "exit" and len(tokens) == 1:
           self.shutdown()
         else:
@@ -182,11 +258,13 @@ class NetworkServer:
     with self.connection_lock:
       self.connection_map[src][dest] = False
       self.connection_map[dest][src] = False
+    self.broadcast_links()
 
   def fixLink(self, src, dest):
     with self.connection_lock:
       self.connection_map[src][dest] = True
       self.connection_map[dest][src] = True
+    self.broadcast_links()
 
   def failNode(self, nodeNum):
     with self.connection_lock:
@@ -206,6 +284,7 @@ class NetworkServer:
       }
         self.forward_message(kill_message)
         logging.info(f"Sent KILL message to node {nodeNum}")
+        self.outbound.pop(nodeNum).close()
         self.connections[nodeNum].close()
         del self.connections[nodeNum]
       except Exception as e:
@@ -0,0 +1,103 @@
+import threading
+import logging
+import collections
+from frame_codec import FrameCodec
+
+class OutboundQueue:
+  """
+  Outgoing frames for one socket, queued per destination and drained by a
+  dedicated writer thread. Callers never block on the socket: they enqueue a
+  frame and return. The writer takes frames round-robin across destinations
+  and coalesces them into a single vectored write with sendmsg.
+  """
+
+  MAX_BATCH = 64 # frames per sendmsg, keeps the iovec count well under IOV_MAX
+
+  def __init__(self, sock, name="", codec=None):
+    self.sock = sock
+    self.name = name
+    self.codec = codec or FrameCodec()
+    self.queues = {} # dest -> deque of frames, each frame a list of buffers
+    self.ready = collections.deque() # destinations with queued frames, in round-robin order
+    self.pending = 0 # frames queued or being written
+    self.closed = False
+    self.condition = threading.Condition()
+    self.writer = threading.Thread(target=self.drain, daemon=True)
+    self.writer.start()
+
+  def send(self, dest, *parts):
+    """
+    Queue a length-prefixed frame made of the given byte buffers for dest.
+    The parts are written back to back, so a payload shared by several
+    destinations only needs to be encoded once. Compression, if negotiated,
+    runs here on the caller's thread rather than in the writer.
+    """
+    frame = self.codec.encode(parts)
+    with self.condition:
+      if self.closed:
+        logging.error(f"Dropping frame for {dest}, outbound queue {self.name} is closed")
+        return
+      queue = self.queues.setdefault(dest, collections.deque())
+      if not queue:
+        self.ready.append(dest)
+      queue.append(frame)
+      self.pending += 1
+      self.condition.notify_all()
+
+  def next_batch(self):
+    batch = []
+    while self.ready and len(batch) < self.MAX_BATCH:
+      dest = self.ready.popleft()
+      queue = self.queues[dest]
+      batch.append(queue.popleft())
+      if queue:
+        self.ready.append(dest)
+    return batch
+
+  def drain(self):
+    while True:
+      with self.condition:
+        self.condition.wait_for(lambda: self.ready or self.closed)
+        if not self.ready:
+          return
+        batch = self.next_batch()
+
+      try:
+        self.write(batch)
+      except OSError as e:
+        logging.error(f"Outbound queue {self.name} failed to write: {e}")
+        with self.condition:
+          self.closed = True
+          self.queues.clear()
+          self.ready.clear()
+          self.pending = 0
+          self.condition.notify_all()
+        return
+
+      with self.condition:
+        self.pending -= len(batch)
+        self.condition.notify_all()
+
+  def write(self, batch):
+    buffers = [memoryview(part) for frame in batch for part in frame if part]
+    while buffers:
+      sent = self.sock.sendmsg(buffers)
+      # Drop fully written buffers and trim a partially written one
+      while sent:
+        if sent >= len(buffers[0]):
+          sent -= len(buffers.pop(0))
+        else:
+          buffers[0] = buffers[0][sent:]
+          sent = 0
+
+  def flush(self, timeout=None):
+    """Wait until every queued frame has been handed to the socket."""
+    with self.condition:
+      return self.condition.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+  def close(self, timeout=5.0):
+    """Write out what is already queued, then stop the writer thread."""
+    self.flush(timeout=timeout)
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
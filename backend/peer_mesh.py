@@ -0,0 +1,279 @@
+import collections
+import json
+import logging
+import socket
+import threading
+import time
+import frame_codec
+from frame_codec import FrameCodec
+from outbound import OutboundQueue
+
+MESH_PORT_OFFSET = 100 # node i accepts peer connections on base_port + MESH_PORT_OFFSET + i
+
+def mesh_port(base_port, node):
+  return base_port + MESH_PORT_OFFSET + node
+
+def recvall(sock, n):
+  """Helper function to read exactly n bytes."""
+  data = bytearray()
+  while len(data) < n:
+    packet = sock.recv(n - len(data))
+    if not packet:
+      return None  # Connection closed or error
+    data.extend(packet)
+  return bytes(data)
+
+def read_message(sock, codec):
+  """Read one frame and return the decoded message, or None once the connection closes."""
+  raw_length = recvall(sock, 4)
+  if not raw_length:
+    return None
+  message_length, compressed = frame_codec.parse_prefix(raw_length)
+  message_bytes = recvall(sock, message_length)
+  if not message_bytes:
+    return None
+  return json.loads(codec.decode(message_bytes, compressed).decode('utf-8'))
+
+class DelayLine:
+  """
+  Holds the frames for one peer back by the mesh delay, then hands them to
+  its OutboundQueue in the order they were sent. One thread per peer, rather
+  than a timer per frame.
+  """
+
+  def __init__(self, queue, name):
+    self.queue = queue
+    self.pending = collections.deque() # (due time, dest, parts)
+    self.condition = threading.Condition()
+    self.closed = False
+    threading.Thread(target=self.run, name=f"delay {name}", daemon=True).start()
+
+  def send(self, delay, dest, *parts):
+    with self.condition:
+      if self.closed:
+        return
+      if delay <= 0 and not self.pending:
+        # Nothing held back, nothing to overtake
+        self.queue.send(dest, *parts)
+        return
+      self.pending.append((time.monotonic() + delay, dest, parts))
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while not self.closed and not self.pending:
+          self.condition.wait()
+        if self.closed:
+          return
+        due, dest, parts = self.pending[0]
+        remaining = due - time.monotonic()
+        if remaining > 0:
+          self.condition.wait(remaining)
+          continue
+        # Sent under the condition so a frame passed straight through in
+        # send() cannot overtake this one
+        self.pending.popleft()
+        self.queue.send(dest, *parts)
+
+  def close(self):
+    """Drop held frames and stop the thread; the queue is closed by its owner."""
+    with self.condition:
+      self.closed = True
+      self.pending.clear()
+      self.condition.notify()
+
+class PeerMesh:
+  """
+  Direct connections between ProcessServers, so Paxos traffic takes one hop
+  instead of going through the NetworkServer. Every node dials each peer and
+  sends on that connection, and receives on the connections its peers dial.
+
+  The NetworkServer remains the control plane: it distributes LINKSTATE
+  messages with the links and delay it would have applied, and they are
+  enforced here on both ends. send() returns False for a peer without a
+  direct connection so the caller can fall back to the relay.
+  """
+
+  RETRY_INTERVAL = 1.0 # seconds between attempts to (re)connect to a peer
+
+  def __init__(self, node_id, num_nodes, host, base_port, on_message, compression=True, compress_threshold=1024):
+    self.node_id = node_id
+    self.num_nodes = num_nodes
+    self.host = host
+    self.base_port = base_port
+    self.on_message = on_message
+    self.compression = compression
+    self.compress_threshold = compress_threshold
+    self.is_running = True
+    self.lock = threading.Lock()
+    self.peers = {} # peer id -> OutboundQueue on the connection we dialled
+    self.delay_lines = {} # peer id -> DelayLine feeding that queue
+    self.sockets = set() # every open mesh socket, closed on shutdown
+    self.links = {} # peer id -> link up, as last distributed by the NetworkServer
+    self.delay = 0.0 # seconds each message is held back, mirrors the relay's delay
+    self.counters = collections.Counter()
+    self.server_socket = None
+
+  def start(self):
+    self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server_socket.bind(('localhost', mesh_port(self.base_port, self.node_id)))
+    self.server_socket.listen(self.num_nodes)
+    threading.Thread(target=self.accept_connections, daemon=True).start()
+    for peer in range(self.num_nodes):
+      if peer != self.node_id:
+        threading.Thread(target=self.maintain, args=(peer,), daemon=True).start()
+    logging.info(f"Peer mesh listening on port {mesh_port(self.base_port, self.node_id)}")
+
+  def hello(self):
+    return {
+      "header" : "HELLO",
+      "message" : "",
+      "ballot_number" : (-1, -1, -1),
+      "src" : self.node_id,
+      "context_id" : -1,
+      "contexts": {},
+      "codecs": frame_codec.offer() if self.compression else {}
+    }
+
+  def link_up(self, peer):
+    with self.lock:
+      return self.links.get(peer, False)
+
+  def update_links(self, links, delay):
+    """Apply a LINKSTATE from the NetworkServer: our row of its connection map and its delay."""
+    with self.lock:
+      self.links = {peer: bool(up) for peer, up in enumerate(links) if peer != self.node_id}
+      self.delay = delay
+    logging.info(f"Peer mesh links {self.links}, delay {delay}s")
+
+  def maintain(self, peer):
+    """Keep a connection to peer open, redialling whenever it drops."""
+    while self.is_running:
+      with self.lock:
+        connected = peer in self.peers
+      if not connected:
+        self.dial(peer)
+      time.sleep(self.RETRY_INTERVAL)
+
+  def dial(self, peer):
+    try:
+      sock = socket.create_connection((self.host, mesh_port(self.base_port, peer)), timeout=self.RETRY_INTERVAL)
+      sock.settimeout(None)
+    except OSError:
+      return
+    codec = FrameCodec(threshold=self.compress_threshold)
+    queue = OutboundQueue(sock, name=f"peer {peer}", codec=codec)
+    queue.send(peer, json.dumps(self.hello()).encode('utf-8'))
+    with self.lock:
+      self.peers[peer] = queue
+      self.delay_lines[peer] = DelayLine(queue, f"peer {peer}")
+      self.sockets.add(sock)
+    logging.info(f"Connected directly to peer {peer}")
+    threading.Thread(target=self.receive, args=(sock, codec, peer), daemon=True).start()
+
+  def accept_connections(self):
+    while self.is_running:
+      try:
+        sock, _ = self.server_socket.accept()
+      except OSError as e:
+        if self.is_running:
+          logging.error(f"Peer mesh failed to accept: {e}")
+        return
+      with self.lock:
+        self.sockets.add(sock)
+      threading.Thread(target=self.receive, args=(sock, FrameCodec(threshold=self.compress_threshold)), daemon=True).start()
+
+  def receive(self, sock, codec, peer=None):
+    """
+    Read messages from one mesh connection. On an accepted connection the
+    first message is the dialling peer's HELLO; on a dialled one the only
+    message expected is the HELLO reply that turns on compression.
+    """
+    try:
+      while self.is_running:
+        message = read_message(sock, codec)
+        if message is None:
+          break
+        if message["header"] == "HELLO":
+          codec.enable(message.get("codecs", {}))
+          if peer is None:
+            peer = message["src"]
+            # Nothing else is ever sent on an accepted connection, write the reply directly
+            sock.sendall(b"".join(FrameCodec().encode([json.dumps(self.hello()).encode('utf-8')])))
+          continue
+        if not self.link_up(message["src"]):
+          self.count("dropped")
+          logging.error(f"Dropping message from {message['src']}, link is down")
+          continue
+        self.count("received")
+        if not self.on_message(message):
+          break
+    except OSError as e:
+      if self.is_running:
+        logging.error(f"Peer mesh connection to {peer} failed: {e}")
+    finally:
+      with self.lock:
+        self.sockets.discard(sock)
+        queue = self.peers.get(peer)
+        if queue is not None and queue.sock is sock:
+          del self.peers[peer]
+          delay_line = self.delay_lines.pop(peer)
+        else:
+          queue = None
+      if queue is not None:
+        delay_line.close()
+        queue.close(timeout=0)
+      sock.close()
+
+  def send(self, dest, *parts):
+    """
+    Send a frame straight to dest. Returns False if there is no direct
+    connection, in which case the caller should route it through the relay.
+    """
+    with self.lock:
+      queue = self.peers.get(dest)
+      delay_line = self.delay_lines.get(dest)
+      up = self.links.get(dest, False)
+      delay = self.delay
+    if queue is None or queue.closed:
+      self.count("relayed")
+      return False
+    if not up:
+      self.count("dropped")
+      logging.error(f"Failed to send message from {self.node_id} to {dest}, link is down")
+      return True
+    self.count("direct")
+    # Hold the frame back like the relay would, without blocking the caller
+    delay_line.send(delay, dest, *parts)
+    return True
+
+  def count(self, counter):
+    with self.lock:
+      self.counters[counter] += 1
+
+  def stats(self):
+    with self.lock:
+      stats = dict(self.counters)
+      stats["peers"] = sorted(self.peers)
+    return stats
+
+  def close(self):
+    self.is_running = False
+    with self.lock:
+      queues = list(self.peers.values())
+      delay_lines = list(self.delay_lines.values())
+      sockets = list(self.sockets)
+      self.peers.clear()
+      self.delay_lines.clear()
+    for delay_line in delay_lines:
+      delay_line.close()
+    for queue in queues:
+      queue.close(timeout=1.0)
+    for sock in sockets + ([self.server_socket] if self.server_socket else []):
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      sock.close()
@@ -1,23 +1,45 @@
 import socket
-import threading
 import argparse
 import logging
 import collections
+import itertools
 import json
 import os
-import struct
 import sys
+import uuid
+import frame_codec
+from frame_codec import FrameCodec, SharedPayload
 from llm_service import LLMService
+from outbound import OutboundQueue
+from peer_mesh import PeerMesh
+from response_store import ResponseStore
+from request_dedup import RequestDedupTable, make_request_id, split_command, tag_command
+from runtime import ThreadRuntime
 from dotenv import load_dotenv
 
 class ProcessServer:
-  def __init__(self, id, target_host, target_port):
+  def __init__(self, id, target_host, target_port, compression=True, compress_threshold=1024, context_budget_bytes=64 * 1024 * 1024, query_deadline=60.0, direct=False, state_dir=None, runtime=None, service=None):
     """
     Initialize the ProcessServer with the target NetworkServer's host and port.
+    runtime and service default to real threads and the Gemini backed
+    LLMService; the simulator passes virtual-clock replacements. With
+    direct, Paxos messages go straight to peers over a PeerMesh and the
+    NetworkServer only distributes link state and relays as a fallback.
+    With state_dir, contexts are kept in a segment file there and recovered
+    when the server restarts.
     """
+    self.runtime = runtime or ThreadRuntime()
+    self.started_at = self.runtime.time()
+    self.startup_phases = {} # phase -> seconds since start when it finished
     self.target_host = target_host
     self.target_port = target_port
     self.socket = None
+    self.outbound = None
+    self.compression = compression
+    self.codec = FrameCodec(threshold=compress_threshold)
+    self.compress_threshold = compress_threshold
+    self.direct = direct
+    self.mesh = None
     self.is_running = True
     self.server_port = self.target_port + 1 + id
     self.leader = -1 # keep track of the current leader in multi paxos
@@ -33,21 +55,62 @@ class ProcessServer:
     }
     
     self.promised_num = 0
-    self.proposal_condition = threading.Condition() # Are there edge cases associated with this?
+    self.proposal_condition = self.runtime.Condition() # Are there edge cases associated with this?
     # Logic is once greater than majority, will send decide and then reset to 0, this assumes one accept at a time, which aligns with multi paxos assumptions
     self.accepted_num = 0
     # self.accepted_lock = threading.Lock()
-    self.accepted_condition = threading.Condition()
+    self.accepted_condition = self.runtime.Condition()
     self.pending_operations = collections.deque() # each entry is a command
-    self.send_lock = threading.Lock()
-    self.operation_event = threading.Event()
-    self.leader_ack_event = threading.Event()
+    self.operation_event = self.runtime.Event()
+    self.leader_ack_event = self.runtime.Event()
+
+    # Commands this leader has decided but not yet announced. They ride on the
+    # next ACCEPT, a standalone DECIDE is only sent once the pipeline goes idle
+    self.unannounced_commits = []
+    self.commits_lock = self.runtime.Lock()
+    self.decide_linger = 0.2
+
+    # Commands are tagged with a request ID unique to this incarnation so that
+    # retries after a FORWARD timeout are applied only once on every replica
+    self.client_id = f"{id}.{uuid.uuid4().hex[:6]}"
+    self.request_seq = itertools.count(1)
+    self.dedup = RequestDedupTable()
+    self.query_deadline = query_deadline # seconds a client query may take end to end
+
+    # LLM responses are kept locally by content hash, a choose replicates only
+    # the (context, server, hash) reference. The text travels on the FORWARD
+    # to the leader, replicas missing it FETCH it as soon as the ACCEPT arrives
+    self.responses = ResponseStore(condition=self.runtime.Condition())
+    self.fetch_timeout = 10.0
+    self.fetches = {} # (context, server, digest) -> time our FETCH for it went out
+    self.fetches_lock = self.runtime.Lock()
+
+    # The leader gives every command it decides the next commit index and a
+    # single applier applies them in index order. Messages carry the sender's
+    # commit index; a replica that is behind and missing the next commit
+    # installs a snapshot a peer took at its own commit index
+    self.commit_index = 0 # last index applied here
+    self.log_index = 0 # highest index assigned here or heard of
+    self.pending_commits = {} # index -> (command, src, ballot_number) waiting to be applied
+    self.ahead = (-1, 0) # (peer, commit index) of the peer furthest ahead of us
+    self.snapshot = None # snapshot from a SYNCDATA, installed by the applier
+    self.sync_requests = [] # SYNCs from peers, served by the applier between commits
+    self.sync_requested_at = None # time our last SYNC went out
+    self.sync_grace = 2.0 # seconds a missing commit may be late before we SYNC
+    self.apply_condition = self.runtime.Condition()
 
     # Initialize the LLM service
-    api_key = os.getenv('GEMINI_API_KEY')
-    if not api_key:
-        raise EnvironmentError("Please set GEMINI_API_KEY environment variable")
-    self.service = LLMService(api_key)
+    if service is None:
+      api_key = os.getenv('GEMINI_API_KEY')
+      if not api_key:
+          raise EnvironmentError("Please set GEMINI_API_KEY environment variable")
+      segment_path = None
+      if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+        segment_path = os.path.join(state_dir, f"server{id}.contexts")
+      service = LLMService(api_key, context_budget_bytes=context_budget_bytes, segment_path=segment_path)
+    self.service = service
+    self.mark_phase("recover")
     
     
   def connect(self):
@@ -59,18 +122,62 @@ class ProcessServer:
       self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
       self.socket.bind(('localhost', self.server_port))
       self.socket.connect((self.target_host, self.target_port))
+      self.outbound = OutboundQueue(self.socket, name="relay", codec=self.codec)
+      self.send_hello()
       logging.info(f"ProcessServer connected to NetworkServer at {self.target_host}:{self.target_port}")
+      if self.direct:
+        self.mesh = PeerMesh(self.ballot["id"], self.num_nodes, self.target_host, self.target_port, self.handle_message, self.compression, self.compress_threshold)
+        self.mesh.start()
+
+      self.mark_phase("connect")
 
       # Start a thread to listen for incoming messages
-      listener_thread = threading.Thread(target=self.listen, daemon=True)
-      listener_thread.start()
-      
-      consensus_thread = threading.Thread(target=self.handle_consensus, daemon=True)
-      consensus_thread.start()
+      self.runtime.spawn(self.listen)
+      self.runtime.spawn(self.handle_consensus)
+      self.runtime.spawn(self.apply_commits)
+      self.mark_phase("consensus")
+      print(f"Ready in {self.startup_phases['consensus']:.3f}s ({self.describe_startup()}), {len(self.service.contexts)} contexts recovered")
+
+      # The LLM client is only needed once a query is decided, load it in the background
+      self.service.warmup().add_done_callback(self.report_warmup)
 
     except Exception as e:
       logging.exception(f"ProcessServer failed to connect to {self.target_host}:{self.target_port}: {e}")
       
+  def mark_phase(self, phase):
+    """Record how long after start a startup phase finished."""
+    self.startup_phases[phase] = self.runtime.time() - self.started_at
+
+  def describe_startup(self):
+    return ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.startup_phases.items())
+
+  def report_warmup(self, future):
+    if future.cancelled():
+      return
+    if future.exception() is not None:
+      logging.error(f"LLM warmup failed, the client will be loaded on the first query: {future.exception()}")
+      return
+    self.mark_phase("llm")
+    print(f"LLM ready in {self.startup_phases['llm']:.3f}s, {future.result()} contexts preloaded")
+
+  def send_hello(self):
+    """
+    Advertise our frame codecs, if compression is on, and whether we talk to
+    peers directly. The relay answers with its own HELLO.
+    """
+    hello = {
+      "header" : "HELLO",
+      "message" : "",
+      "ballot_number" : self.ballot_to_tuple(),
+      "dest" : -1,
+      "src" : self.ballot["id"],
+      "context_id" : -1,
+      "contexts": {},
+      "codecs": frame_codec.offer() if self.compression else {},
+      "direct": self.direct
+    }
+    self.outbound.send(-1, json.dumps(hello).encode('utf-8'))
+
   def recvall(self, sock, n):
     """Helper function to read exactly n bytes."""
     data = bytearray()
@@ -81,7 +188,6 @@ class ProcessServer:
         data.extend(packet)
     return bytes(data)
   
-  # might want to split this function up into one that receives the message and one that processes the message in a new thread?
   def listen(self):
     """
     Listen for incoming messages from the NetworkServer.
@@ -92,87 +198,126 @@ class ProcessServer:
         if not raw_length:
           break  
         
-        message_length = struct.unpack('>I', raw_length)[0]
+        message_length, compressed = frame_codec.parse_prefix(raw_length)
 
         message_bytes = self.recvall(self.socket, message_length)
         if not message_bytes:
           break
 
-        message = json.loads(message_bytes.decode('utf-8'))
-        header = message["header"]
-        ballot_number = message["ballot_number"]
-        content = message["message"]
-        src = message["src"]
-        src_dict = message["contexts"]
-        if header == "KILL":
-          print("ProcessServer received KILL message.")
-          self.shutdown()
+        message = json.loads(self.codec.decode(message_bytes, compressed).decode('utf-8'))
+        if not self.handle_message(message):
           break
-        elif header == "ACCEPT":
-          print(f"Received ACCEPT <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          response_thread = threading.Thread(target=self.send_response, args=("ACCEPTED", src, ballot_number, content, -1, True,), daemon=True)
-          response_thread.start()
-        elif header == "ACCEPTED":
-          print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          # maybe start in a new thread?
-          with self.accepted_condition:
-            self.accepted_num += 1
-            self.accepted_condition.notify_all()
-        elif header == "PROPOSE":
-          print(f"Received PROPOSE <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          propose_response_thread = threading.Thread(target=self.send_response, args=("PROMISE", src, ballot_number, content,-1, True,), daemon=True)
-          propose_response_thread.start()
-        elif header == "PROMISE":
-          print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          with self.proposal_condition:
-            self.promised_num += 1
-            self.proposal_condition.notify_all()
-        elif header == "FORWARD":
-          ballot_number = message["ballot_number"]
-          content = message["message"]
-          if self.leader == -1:
-            print("Forfeiting leader status")
-            continue
-          print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          forward_thread = threading.Thread(target=self.send_response, args=("ACK", src, ballot_number, content,), daemon=True)
-          forward_thread.start()
-          self.pending_operations.append(content)
-          self.operation_event.set()
-        elif header == "ACK":
-          content = message["message"]
-          self.leader_ack_event.set()
-          print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-        elif header == "DECIDE":
-          # create new decide function
-          print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
-          msg = message["message"]
-          decide_thread = threading.Thread(target=self.decide, args=(msg, src, ballot_number, src_dict,), daemon=True)
-          decide_thread.start()
-        elif header == "RESPONSE":
-            context_id = message["context_id"]
-            server_id = src
-            response = message["message"]
-            
-            if context_id not in self.collected_responses:
-                self.collected_responses[context_id] = {}
-            
-            self.collected_responses[context_id][server_id] = response
-            
-            print(f"\nReceived from server {server_id} for context {context_id}:")
-            print(f"Response: {response}\n")
-        else:
-            logging.warning(f"ProcessServer received unknown message: {message}")
     except Exception as e:
       if self.is_running:
           logging.exception(f"ProcessServer error while listening: {e}")
     finally:
       self.socket.close()
       logging.info("ProcessServer connection closed")
-  
+
+  def handle_message(self, message):
+    """
+    Dispatch one received message. Anything that may block is handed to a
+    new thread. Returns False once the server should stop receiving.
+    """
+    header = message["header"]
+    ballot_number = message["ballot_number"]
+    content = message["message"]
+    src = message["src"]
+    if src != -1 and "commit_index" in message:
+      self.note_commit_index(src, message["commit_index"])
+    if header == "KILL":
+      print("ProcessServer received KILL message.")
+      self.shutdown()
+      return False
+    elif header == "HELLO":
+      enabled = self.compression and self.codec.enable(message.get("codecs", {}))
+      logging.info(f"Compression with NetworkServer: {'on' if enabled else 'off'}")
+    elif header == "ACCEPT":
+      print(f"Received ACCEPT <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      self.prefetch_chosen(content)
+      self.runtime.spawn(self.send_response, "ACCEPTED", src, ballot_number, content, -1, True)
+      if message.get("commits"):
+        self.enqueue_commits(message["commits"], src, ballot_number)
+    elif header == "ACCEPTED":
+      print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      # maybe start in a new thread?
+      with self.accepted_condition:
+        self.accepted_num += 1
+        self.accepted_condition.notify_all()
+    elif header == "PROPOSE":
+      print(f"Received PROPOSE <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      self.runtime.spawn(self.send_response, "PROMISE", src, ballot_number, content, -1, True)
+    elif header == "PROMISE":
+      print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      with self.proposal_condition:
+        self.promised_num += 1
+        self.proposal_condition.notify_all()
+    elif header == "FORWARD":
+      ballot_number = message["ballot_number"]
+      content = message["message"]
+      if self.leader == -1:
+        print("Forfeiting leader status")
+        return True
+      print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      self.store_chosen(message)
+      self.runtime.spawn(self.send_response, "ACK", src, ballot_number, content)
+      self.pending_operations.append(content)
+      self.operation_event.set()
+    elif header == "ACK":
+      content = message["message"]
+      self.leader_ack_event.set()
+      print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+    elif header == "DECIDE":
+      # create new decide function
+      print(f"Received {header} <{ballot_number[0]} {ballot_number[1]} {ballot_number[2]}> {content} from Server {src}")
+      self.enqueue_commits(message.get("commits", []), src, ballot_number)
+    elif header == "RESPONSE":
+        context_id = message["context_id"]
+        server_id = src
+        response = message["message"]
+        
+        if context_id not in self.collected_responses:
+            self.collected_responses[context_id] = {}
+        
+        self.collected_responses[context_id][server_id] = response
+        self.responses.put(context_id, server_id, response)
+        
+        print(f"\nReceived from server {server_id} for context {context_id}:")
+        print(f"Response: {response}\n")
+    elif header == "FETCH":
+      self.runtime.spawn(self.serve_fetch, src, ballot_number, content)
+    elif header == "SYNC":
+      with self.apply_condition:
+        self.sync_requests.append((src, ballot_number, int(content), message.get("context_sizes", {})))
+        self.apply_condition.notify_all()
+    elif header == "SYNCDATA":
+      with self.apply_condition:
+        if message["snapshot"]["index"] > max(self.commit_index, self.snapshot["index"] if self.snapshot else 0):
+          self.snapshot = message["snapshot"]
+          self.apply_condition.notify_all()
+    elif header == "BLOB":
+      server_id, digest = message["blob"]
+      if not self.responses.put_verified(message["context_id"], server_id, digest, content):
+        logging.error(f"Discarding BLOB from Server {src} with mismatched digest {digest}")
+    elif header == "LINKSTATE":
+      # Links and delay the relay would apply, enforced locally on the direct mesh
+      if self.mesh and src == -1:
+        self.mesh.update_links(message["links"], message.get("delay", 0))
+    elif header == "CLIENT":
+      # Client command injected by a NetworkServer scenario, as if typed on the console
+      if src == -1 and content.split(" ", 1)[0] in ("create", "query"):
+        self.submit(content)
+      else:
+        logging.warning(f"Ignoring CLIENT command {content} from {src}")
+    else:
+        logging.warning(f"ProcessServer received unknown message: {message}")
+    return True
+
   def handle_consensus(self):
     # leader is unknown, send proposal
     while self.is_running:
       self.operation_event.wait()
+      self.operation_event.clear()
       while self.pending_operations:
         command = self.pending_operations[0]
         ballot_number = self.ballot_to_tuple()
@@ -185,7 +330,7 @@ class ProcessServer:
             continue
         elif self.leader != self.ballot["id"]:
           self.leader_ack_event.clear()
-          self.send_response("FORWARD", self.leader, ballot_number, command)
+          self.send_response("FORWARD", self.leader, ballot_number, command, extra=self.chosen_blob(command))
           ack_received = self.leader_ack_event.wait(timeout=10.0)
           
           if not ack_received:
@@ -204,7 +349,11 @@ class ProcessServer:
         self.reach_consensus(command, ballot_number)
         self.pending_operations.popleft()
         logging.debug(f"Done reaching consensus, pending operations: {self.pending_operations}")
-      self.pending_operations.clear()
+
+      # Pipeline is idle, give the next command a moment to carry our commits
+      # before falling back to a standalone DECIDE
+      if self.unannounced_commits and not self.operation_event.wait(timeout=self.decide_linger):
+        self.announce_commits()
 
   def leader_election(self, command, ballot_number):
     self.promised_ballot = self.ballot_to_tuple()
@@ -217,19 +366,46 @@ class ProcessServer:
     return received_promise_majority
 
   def reach_consensus(self, command, ballot_number):      
-    # Send ACCEPT message:
-    self.send_message(header="ACCEPT", content=command, ballot_number=ballot_number)
+    # A choose only commits if the leader can serve the chosen text to acceptors missing it
+    key = self.chosen_key(command)
+    if key and self.fetch_response(*key) is None:
+      logging.error(f"Dropping {command}, the chosen answer is not available")
+      return
+
+    # Send ACCEPT message, carrying any commits followers have not heard about:
+    commits = self.take_unannounced_commits()
+    self.send_message(header="ACCEPT", content=command, ballot_number=ballot_number, extra={"commits": commits} if commits else None)
     self.accepted_num = 0
     with self.accepted_condition:
       received_accept_majority = self.accepted_condition.wait_for(lambda: self.accepted_num >= self.majority, timeout=10.0)
     
     if not received_accept_majority:
       print("TIMEOUT waiting for majority ACCEPTORS")
+      # Followers may have missed the piggybacked commits, announce them again
+      # later; request IDs make a repeated decide harmless
+      with self.commits_lock:
+        self.unannounced_commits[:0] = commits
       return
       
-    # Send DECIDE message:
-    self.decide(message=command, src=-1, ballot_number=ballot_number, is_leader=True)
-    self.send_message(header="DECIDE", content=command, ballot_number=ballot_number)
+    # Decide locally, followers learn about it on the next ACCEPT or DECIDE:
+    with self.apply_condition:
+      self.log_index = max(self.log_index, self.commit_index) + 1
+      commit = [self.log_index, command]
+    self.enqueue_commits([commit], -1, ballot_number)
+    with self.commits_lock:
+      self.unannounced_commits.append(commit)
+
+  def take_unannounced_commits(self):
+    with self.commits_lock:
+      commits = self.unannounced_commits
+      self.unannounced_commits = []
+    return commits
+
+  def announce_commits(self):
+    """Send a standalone DECIDE for every commit not yet piggybacked."""
+    commits = self.take_unannounced_commits()
+    if commits:
+      self.send_message(header="DECIDE", content=commits[-1][1], ballot_number=self.ballot_to_tuple(), extra={"commits": commits})
 
   # when a proposal fails, want to increment the proposal value
   def increment_ballot(self):
@@ -245,78 +421,222 @@ class ProcessServer:
     return (self.promised_ballot[2], self.promised_ballot[0], self.promised_ballot[1]) > (ballot_number[2], ballot_number[0], ballot_number[1])
 
   
-  def send_message(self, header, content, ballot_number, context_id=-1):
+  def encode_message(self, header, content, ballot_number, context_id=-1, extra=None):
+    """
+    Serialize everything but the destination of a message. The result is an
+    unterminated JSON object which frame_tail() completes for a given dest,
+    so a broadcast is encoded once no matter how many peers receive it.
+    """
+    message = {
+      "header" : header,
+      "message" : content,
+      "ballot_number" : ballot_number,
+      "src" : self.ballot["id"],
+      "context_id" : context_id,
+      "commit_index": self.commit_index
+    }
+    if extra:
+      message.update(extra)
+    return json.dumps(message).encode('utf-8')[:-1]
+
+  def frame_tail(self, dest):
+    return f', "dest": {dest}}}'.encode('utf-8')
+
+  def send_message(self, header, content, ballot_number, context_id=-1, extra=None):
     print(f"Sending {header} <{ballot_number[0]}, {ballot_number[1]}, {ballot_number[2]}> {content} to ALL")
+    shared = SharedPayload(self.encode_message(header, content, ballot_number, context_id, extra))
     for node in range(self.num_nodes):
       if node == self.ballot["id"]:
         continue
-      
-      message = {
-        "header" : header,
-        "message" : content,
-        "ballot_number" : ballot_number,
-        "dest" : node,
-        "src" : self.ballot["id"],
-        "context_id" : context_id,
-        "contexts": self.service.get_all_contexts()
-      }
-      
-      # Maybe consider having a send lock if this becomes a problem
-      # Serialize the message to JSON and encode it to bytes
-      message_bytes = json.dumps(message).encode('utf-8')
-
-      # Calculate the length of the message
-      message_length = len(message_bytes)
+      self.transmit(node, shared, self.frame_tail(node))
 
-      # Pack the length into 4 bytes using big-endian format
-      length_prefix = struct.pack('>I', message_length)
-
-      # Send the length prefix followed by the message bytes
-      with self.send_lock:
-        self.socket.sendall(length_prefix + message_bytes)
+  def transmit(self, dest, *parts):
+    """Send a frame directly over the mesh if we have a connection to dest, through the relay otherwise."""
+    if self.mesh and self.mesh.send(dest, *parts):
+      return
+    self.outbound.send(dest, *parts)
 
   # TODO: update this to handle leader election
-  def send_response(self, header, dest, ballot_number, content, context_id=-1, requires_ballot_comparison=False):
+  def send_response(self, header, dest, ballot_number, content, context_id=-1, requires_ballot_comparison=False, extra=None):
     # print(f"curr ballot: {self.max_ballot}, received ballot: {ballot_number}, comparison result {self.compare_ballot(ballot_number)}, flag: {requires_ballot_comparison}")
     if self.compare_ballot(ballot_number) and requires_ballot_comparison:
       print(f"Did not {header} <{ballot_number[0]}, {ballot_number[1]}, {ballot_number[2]}> {content} from Server {dest}")
       return
     
     print(f"Sending {header} <{ballot_number[0]}, {ballot_number[1]}, {ballot_number[2]}> {content} to Server {dest}")
-    message = {
-      "header" : header,
-      "message" : content,
-      "ballot_number" : ballot_number,
-      "dest" : dest,
-      "src" : self.ballot["id"],
-      "context_id" : context_id,
-      "contexts": self.service.get_all_contexts()
-    }
-  
-    # Serialize the message to JSON and encode it to bytes
-    message_bytes = json.dumps(message).encode('utf-8')
-
-    # Calculate the length of the message
-    message_length = len(message_bytes)
-
-    # Pack the length into 4 bytes using big-endian format
-    length_prefix = struct.pack('>I', message_length)
-
-    # Maybe consider having a send lock if this becomes a problem
-    with self.send_lock:
-      self.socket.sendall(length_prefix + message_bytes)
+    shared = self.encode_message(header, content, ballot_number, context_id, extra)
+    self.transmit(dest, shared, self.frame_tail(dest))
     
     if header == "PROMISE" or header == "ACCEPTED":
       self.leader = dest
       self.promised_ballot = ballot_number
       logging.debug(f"LEADER is set to {dest}")
   
-  def decide(self, message, src, ballot_number, src_dict={}, is_leader=False):
-    """Handle consensus decisions and coordinate responses."""
-    tokens = message.strip().split()
+  def enqueue_commits(self, commits, src, ballot_number):
+    """Hand [index, command] commits to the applier, ignoring ones already applied."""
+    with self.apply_condition:
+      for index, command in commits:
+        if index > self.commit_index:
+          self.pending_commits.setdefault(index, (command, src, ballot_number))
+          self.log_index = max(self.log_index, index)
+      self.apply_condition.notify_all()
+
+  def note_commit_index(self, src, commit_index):
+    with self.apply_condition:
+      self.log_index = max(self.log_index, commit_index)
+      if commit_index > self.ahead[1]:
+        self.ahead = (src, commit_index)
+        self.apply_condition.notify_all()
+
+  def apply_commits(self):
+    """
+    The applier: applies commits in index order, one at a time. Snapshots
+    are installed and SYNCs served between two commits, so a snapshot always
+    holds exactly the commits up to the index it is taken at.
+    """
+    ready = lambda: not self.is_running or self.snapshot is not None or self.sync_requests or self.commit_index + 1 in self.pending_commits
+    while self.is_running:
+      with self.apply_condition:
+        if not ready():
+          if self.ahead[1] <= self.commit_index:
+            self.apply_condition.wait()
+          elif not self.apply_condition.wait_for(ready, timeout=self.sync_grace):
+            # A peer has applied commits that never reached us, catch up from it
+            self.runtime.spawn(self.request_sync, self.ahead[0])
+          continue
+        if not self.is_running:
+          return
+        snapshot, self.snapshot = self.snapshot, None
+        requests, self.sync_requests = self.sync_requests, []
+        entry = self.pending_commits.pop(self.commit_index + 1, None) if snapshot is None else None
+
+      for request in requests:
+        self.serve_sync(*request)
+      if snapshot is not None:
+        self.install_snapshot(snapshot)
+      elif entry is not None:
+        command, src, ballot_number = entry
+        applied = self.decide(command, src, ballot_number, is_leader=src == -1)
+        with self.apply_condition:
+          if applied:
+            self.commit_index += 1
+          else:
+            # Retried until it applies or a snapshot moves us past it
+            self.pending_commits[self.commit_index + 1] = entry
+        if not applied and src != -1:
+          self.request_sync(src)
+
+  def request_sync(self, dest):
+    """Ask dest for a snapshot, at most once per fetch_timeout."""
+    now = self.runtime.time()
+    with self.apply_condition:
+      if self.sync_requested_at is not None and now - self.sync_requested_at < self.fetch_timeout:
+        return
+      self.sync_requested_at = now
+      commit_index = self.commit_index
+    self.send_response(header="SYNC", dest=dest, ballot_number=self.ballot_to_tuple(), content=str(commit_index), extra={"context_sizes": self.service.get_context_sizes()})
+
+  def serve_sync(self, dest, ballot_number, commit_index, context_sizes):
+    """
+    Send dest our state at our commit index, if it is behind it. Contexts
+    are append-only, so only the ones whose size differs from dest's are sent.
+    """
+    if commit_index >= self.commit_index:
+      return
+    sizes = self.service.get_context_sizes()
+    changed = [context_id for context_id, size in sizes.items() if context_sizes.get(context_id) != size]
+    snapshot = {"index": self.commit_index, "contexts": self.service.get_contexts(changed), "applied": self.dedup.snapshot()}
+    self.send_response(header="SYNCDATA", dest=dest, ballot_number=ballot_number, content="", extra={"snapshot": snapshot})
+
+  def install_snapshot(self, snapshot):
+    if snapshot["index"] <= self.commit_index:
+      return
+    self.service.restore_contexts(snapshot["contexts"])
+    self.dedup.restore(snapshot["applied"])
+    with self.apply_condition:
+      self.commit_index = snapshot["index"]
+      self.log_index = max(self.log_index, self.commit_index)
+      self.sync_requested_at = None
+      for index in [index for index in self.pending_commits if index <= self.commit_index]:
+        del self.pending_commits[index]
+    logging.info(f"Installed snapshot at commit index {self.commit_index}")
+
+  def chosen_key(self, command):
+    """The (context, server, digest) a choose command refers to, None for other commands."""
+    _, body = split_command(command)
+    tokens = body.split()
+    if len(tokens) == 4 and tokens[0] == "choose" and tokens[1].isdigit() and tokens[2].isdigit():
+      return tokens[1], int(tokens[2]), tokens[3]
+    return None
+
+  def chosen_blob(self, command):
+    """Message extra carrying the chosen text of a choose command, if we hold it."""
+    key = self.chosen_key(command)
+    text = self.responses.get(*key) if key else None
+    if text is None:
+      return None
+    return {"chosen": [*key, text]}
+
+  def prefetch_chosen(self, command):
+    """Start fetching the text of an accepted choose we do not hold, so the decide finds it."""
+    key = self.chosen_key(command)
+    if key and self.responses.get(*key) is None:
+      self.runtime.spawn(self.fetch_response, *key)
+
+  def store_chosen(self, message):
+    if "chosen" not in message:
+      return
+    context_id, server_id, digest, text = message["chosen"]
+    if not self.responses.put_verified(context_id, server_id, digest, text):
+      logging.error(f"Discarding chosen answer from Server {message['src']} with mismatched digest {digest}")
+
+  def fetch_response(self, context_id, server_id, digest):
+    """Return a stored response, asking peers for it if it is not held locally."""
+    text = self.responses.get(context_id, server_id, digest)
+    if text is not None:
+      return text
+    # A prefetch and the decide may both want it, only ask once per fetch_timeout
+    key, now = (context_id, server_id, digest), self.runtime.time()
+    with self.fetches_lock:
+      requested = now - self.fetches.get(key, -self.fetch_timeout) < self.fetch_timeout
+      if not requested:
+        self.fetches[key] = now
+    if not requested:
+      self.send_message(header="FETCH", content=f"{context_id} {server_id} {digest}", ballot_number=self.ballot_to_tuple(), context_id=context_id)
+    text = self.responses.wait_for(context_id, server_id, digest, timeout=self.fetch_timeout)
+    with self.fetches_lock:
+      self.fetches.pop(key, None)
+    return text
+
+  def serve_fetch(self, dest, ballot_number, content):
+    tokens = content.split()
+    if len(tokens) != 3 or not tokens[1].isdigit():
+      logging.error(f"Malformed FETCH from Server {dest}: {content}")
+      return
+    context_id, server_id, digest = tokens[0], int(tokens[1]), tokens[2]
+    text = self.responses.get(context_id, server_id, digest)
+    if text is not None:
+      self.send_response(header="BLOB", dest=dest, ballot_number=ballot_number, content=text, context_id=context_id, extra={"blob": [server_id, digest]})
+
+  def decide(self, message, src, ballot_number, is_leader=False):
+    """
+    Apply one committed command and coordinate responses. Returns False if
+    it cannot be applied yet, because the chosen answer is not available.
+    """
+    meta, body = split_command(message)
+    tokens = body.strip().split()
     logging.debug(f"Tokens: {tokens}")
     if not tokens:
-      return
+      return True
+
+    request_id = meta.get("rid")
+    if request_id:
+      duplicate, cached_response = self.dedup.begin(request_id)
+      if duplicate:
+        logging.info(f"Skipping already decided request {request_id}")
+        if not is_leader and cached_response:
+          self.send_response(header="RESPONSE", dest=src, ballot_number=ballot_number, content=cached_response, context_id=tokens[1] if len(tokens) > 1 else -1)
+        return True
         
     command = tokens[0]
     response = ""
@@ -336,30 +656,44 @@ class ProcessServer:
       # Add query to local context
       if self.service.add_query_to_context(context_id, query_string):
         print(f"NEW QUERY on {context_id} with {query_string}")
-        response += self.service.generate_response(context_id)
+        deadline = float(meta["deadline"]) if "deadline" in meta else None
+        if deadline is not None and deadline <= self.runtime.time():
+          response += "Deadline exceeded before a response was generated"
+        else:
+          answer = self.service.generate_response(context_id, deadline)
+          response += answer if answer is not None else "Could not generate a response"
         self.ballot["op"] += 1
         if context_id not in self.collected_responses:
             self.collected_responses[context_id] = {}
         self.collected_responses[context_id][self.ballot["id"]] = response
+        self.responses.put(context_id, self.ballot["id"], response)
 
         print(f"\nReceived from server {self.ballot['id']} for context {context_id}:")
         print(f"Response: {response}\n")
       else:
         logging.error("Failed to decide on QUERY function")
-    elif command == "choose" and len(tokens) >= 3 and tokens[1].isdigit():
+    elif command == "choose" and len(tokens) == 4 and tokens[1].isdigit() and tokens[2].isdigit():
       context_id = tokens[1]
-      chosen_answer = ' '.join(tokens[2:])
+      # Normally prefetched when the ACCEPT arrived, this waits for it if still in flight
+      chosen_answer = self.fetch_response(context_id, int(tokens[2]), tokens[3])
+      if chosen_answer is None:
+        logging.error(f"Could not fetch chosen answer {tokens[3]} from server {tokens[2]} for context {context_id}")
+        # Not applied, leave the request open so the applier can retry it
+        if request_id:
+          self.dedup.abort(request_id)
+        return False
       if self.service.save_answer(context_id, chosen_answer):
         print(f"CHOSEN ANSWER on {context_id} with {chosen_answer}")
         self.ballot["op"] += 1
     else:
       response = "Could not decide!"
+
+    if request_id:
+      self.dedup.complete(request_id, response)
     
-    if not is_leader:
-       self.service.compare_and_update_dict(src_dict)
-       
     if not is_leader and response:
       self.send_response(header="RESPONSE", dest=src, ballot_number=ballot_number, content=response, context_id=context_id)
+    return True
       
   def shutdown(self):
     """
@@ -367,11 +701,19 @@ class ProcessServer:
     """
     self.is_running = False
     print("Shutting Down...")
+    with self.apply_condition:
+      self.apply_condition.notify_all()
     
     try:
       sys.stdout.flush()
     except Exception as e:
       logging.exception(f"Failed to flush stdout: {e}")
+
+    if self.mesh:
+      self.mesh.close()
+
+    if self.outbound:
+      self.outbound.close()
         
     if hasattr(self.socket, 'fileno') and self.socket.fileno() != -1:
       try:
@@ -379,8 +721,23 @@ class ProcessServer:
         self.socket.close()
       except Exception as e:
         logging.exception(f"ProcessServer error while closing socket: {e}")
+
+    try:
+      self.service.close()
+    except Exception as e:
+      logging.exception(f"ProcessServer error while closing context store: {e}")
     logging.info("ProcessServer shutdown complete")
 
+  def submit(self, consensus_message):
+    """Tag a client command with its request ID and queue it for consensus."""
+    request_id = make_request_id(self.client_id, next(self.request_seq))
+    # Queries carry an absolute deadline so every replica stops waiting on the LLM at the same point
+    deadline = f"{self.runtime.time() + self.query_deadline:.3f}" if consensus_message.startswith("query ") else None
+    consensus_message = tag_command(consensus_message, rid=request_id, deadline=deadline)
+    self.pending_operations.append(consensus_message)
+    self.operation_event.set()
+    return request_id
+
   def user_input_handler(self):
     """
     Handle user inputs to send messages.
@@ -407,7 +764,8 @@ class ProcessServer:
           server_id = int(tokens[2])
           if server_id in self.collected_responses.get(context_id, {}):
             chosen_answer = self.collected_responses[context_id][server_id]
-            consensus_message = f"{command} {context_id} {chosen_answer}"
+            digest = self.responses.put(context_id, server_id, chosen_answer)
+            consensus_message = f"{command} {context_id} {server_id} {digest}"
             self.collected_responses.pop(context_id, None)
           else:
             logging.error(f"Cannot find context history for {context_id}")
@@ -421,6 +779,12 @@ class ProcessServer:
           print("\nAll Contexts:")
           for cid, context in contexts.items():
             print(f"\nContext {cid}:\n{context}")
+        elif command == "stats" and len(tokens) == 1:
+          print(f"\nCompression: {self.codec.stats()}")
+          if self.mesh:
+            print(f"Peer mesh: {self.mesh.stats()}")
+          print(f"Startup: {self.describe_startup()}")
+          print(f"LLM: {self.service.get_metrics()}\n")
         elif command == "exit" and len(tokens) == 1:
           logging.info("ProcessServer exiting upon user request.")
           self.shutdown()
@@ -429,8 +793,7 @@ class ProcessServer:
           print("Invalid command.")
 
         if consensus_message:
-          self.pending_operations.append(consensus_message)
-          self.operation_event.set()
+          self.submit(consensus_message)
       except Exception as e:
         logging.exception(f"ProcessServer error handling user input: {e}")
 
@@ -452,6 +815,40 @@ def parse_args():
     default="DEBUG",
     help="Set the logging level. Use 'OFF' to disable logging."
   )
+  parser.add_argument(
+    "--compression",
+    choices=["on", "off"],
+    default="on",
+    help="Offer frame compression to the NetworkServer."
+  )
+  parser.add_argument(
+    "--compress-threshold",
+    type=int,
+    default=1024,
+    help="Only compress frames of at least this many bytes."
+  )
+  parser.add_argument(
+    "--context-budget-mb",
+    type=int,
+    default=64,
+    help="Memory budget for recently used contexts, older ones are paged out to disk."
+  )
+  parser.add_argument(
+    "--query-deadline",
+    type=float,
+    default=60.0,
+    help="Seconds a query may take, from the client through consensus and generation."
+  )
+  parser.add_argument(
+    "--direct",
+    action="store_true",
+    help="Send Paxos messages directly to peers, the NetworkServer only distributes link state."
+  )
+  parser.add_argument(
+    "--state-dir",
+    default=None,
+    help="Keep contexts in a segment file in this directory and recover them on restart."
+  )
   return parser.parse_args()
 
 # Example usage
@@ -474,5 +871,5 @@ if __name__ == "__main__":
   target_port = args.target_port
 
   # Create and run ProcessServer
-  process_server = ProcessServer(id, target_host, target_port)
+  process_server = ProcessServer(id, target_host, target_port, args.compression == "on", args.compress_threshold, args.context_budget_mb * 1024 * 1024, args.query_deadline, args.direct, args.state_dir)
   process_server.run()
@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Commands travelling through Paxos may carry a metadata token in front of the
+# command body, e.g. "#rid=0.1a2b3c:7 query 1 hello". Untagged commands are
+# still accepted so nodes without request IDs keep working.
+META_PREFIX = "#"
+
+
+def make_request_id(client_id: str, seq: int) -> str:
+    """Build a request ID that is unique per client incarnation."""
+    return f"{client_id}:{seq}"
+
+
+def tag_command(command: str, **meta) -> str:
+    """Prefix a command with a metadata token."""
+    fields = ",".join(f"{key}={value}" for key, value in meta.items() if value is not None)
+    if not fields:
+        return command
+    return f"{META_PREFIX}{fields} {command}"
+
+
+def split_command(message: str) -> Tuple[Dict[str, str], str]:
+    """Split a consensus message into its metadata and command body."""
+    stripped = message.lstrip()
+    if not stripped.startswith(META_PREFIX):
+        return {}, message
+
+    token, _, body = stripped.partition(" ")
+    meta = {}
+    for field in token[len(META_PREFIX):].split(","):
+        key, sep, value = field.partition("=")
+        if sep:
+            meta[key] = value
+    return meta, body
+
+
+class RequestDedupTable:
+    """
+    Bounded record of applied requests, used to make retried commands idempotent.
+
+    Each client gets a sliding window of its most recent sequence numbers and
+    the result produced for them. Anything older than the window is treated as
+    already applied, and the least recently active clients are dropped once
+    max_clients is exceeded.
+    """
+
+    IN_FLIGHT = object()
+
+    def __init__(self, window: int = 64, max_clients: int = 256):
+        self.window = window
+        self.max_clients = max_clients
+        self.clients: "OrderedDict[str, Dict]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _parse(request_id: str) -> Optional[Tuple[str, int]]:
+        client_id, sep, seq = request_id.rpartition(":")
+        if not sep or not seq.isdigit():
+            return None
+        return client_id, int(seq)
+
+    def begin(self, request_id: str) -> Tuple[bool, Optional[str]]:
+        """
+        Claim a request for execution.
+
+        Returns (True, cached_result) if the request was already applied or is
+        currently being applied, otherwise records it as in flight and returns
+        (False, None).
+        """
+        parsed = self._parse(request_id)
+        if parsed is None:
+            return False, None
+        client_id, seq = parsed
+
+        with self.lock:
+            state = self.clients.get(client_id)
+            if state is None:
+                state = {"max_seq": 0, "results": {}}
+                self.clients[client_id] = state
+                if len(self.clients) > self.max_clients:
+                    self.clients.popitem(last=False)
+            else:
+                self.clients.move_to_end(client_id)
+
+            results = state["results"]
+            if seq in results:
+                result = results[seq]
+                return True, None if result is self.IN_FLIGHT else result
+            if seq <= state["max_seq"] - self.window:
+                return True, None
+
+            results[seq] = self.IN_FLIGHT
+            if seq > state["max_seq"]:
+                state["max_seq"] = seq
+                low_water = seq - self.window
+                for old_seq in [s for s in results if s <= low_water]:
+                    del results[old_seq]
+            return False, None
+
+    def abort(self, request_id: str) -> None:
+        """Release a request claimed with begin() that could not be applied, so it can be retried."""
+        parsed = self._parse(request_id)
+        if parsed is None:
+            return
+        client_id, seq = parsed
+
+        with self.lock:
+            state = self.clients.get(client_id)
+            if state is not None and state["results"].get(seq) is self.IN_FLIGHT:
+                del state["results"][seq]
+
+    def snapshot(self) -> Dict[str, list]:
+        """
+        Applied requests per client as [max_seq, [seqs]], JSON-friendly and
+        without results, for a replica catching up from a state snapshot.
+        """
+        with self.lock:
+            return {
+                client_id: [state["max_seq"], [seq for seq, result in state["results"].items() if result is not self.IN_FLIGHT]]
+                for client_id, state in self.clients.items()
+            }
+
+    def restore(self, snapshot: Dict[str, list]) -> None:
+        """Replace the table with a snapshot(); restored requests are duplicates without a cached result."""
+        with self.lock:
+            self.clients = OrderedDict(
+                (client_id, {"max_seq": max_seq, "results": {seq: None for seq in seqs}})
+                for client_id, (max_seq, seqs) in snapshot.items()
+            )
+
+    def complete(self, request_id: str, result: Optional[str]) -> None:
+        """Store the result of a request previously claimed with begin()."""
+        parsed = self._parse(request_id)
+        if parsed is None:
+            return
+        client_id, seq = parsed
+
+        with self.lock:
+            state = self.clients.get(client_id)
+            if state is not None and seq in state["results"]:
+                state["results"][seq] = result
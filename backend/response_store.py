@@ -0,0 +1,53 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+class ResponseStore:
+    """
+    Content-addressed store for LLM responses, keyed by (context, server, digest).
+
+    Consensus only carries the key of a chosen answer; the text itself stays
+    here and is fetched from a peer when a replica does not have it.
+    """
+
+    def __init__(self, max_entries: int = 1024, condition: Optional[threading.Condition] = None):
+        self.max_entries = max_entries
+        self.responses: "OrderedDict[Tuple[str, int, str], str]" = OrderedDict()
+        self.condition = condition or threading.Condition()
+
+    @staticmethod
+    def digest(text: str) -> str:
+        """Short content hash of a response."""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+    def put(self, context_id: str, server_id: int, text: str) -> str:
+        """Store a response and return its digest."""
+        digest = self.digest(text)
+        with self.condition:
+            key = (str(context_id), int(server_id), digest)
+            self.responses[key] = text
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)
+            self.condition.notify_all()
+        return digest
+
+    def put_verified(self, context_id: str, server_id: int, digest: str, text: str) -> bool:
+        """Store a response received from a peer, only if it matches the digest it was sent under."""
+        if self.digest(text) != digest:
+            return False
+        self.put(context_id, server_id, text)
+        return True
+
+    def get(self, context_id: str, server_id: int, digest: str) -> Optional[str]:
+        """Retrieve a stored response, or None if it is not held locally."""
+        with self.condition:
+            return self.responses.get((str(context_id), int(server_id), digest))
+
+    def wait_for(self, context_id: str, server_id: int, digest: str, timeout: float) -> Optional[str]:
+        """Block until a response arrives or the timeout expires."""
+        key = (str(context_id), int(server_id), digest)
+        with self.condition:
+            self.condition.wait_for(lambda: key in self.responses, timeout=timeout)
+            return self.responses.get(key)
@@ -0,0 +1,29 @@
+import threading
+import time
+
+class ThreadRuntime:
+  """
+  Threads, synchronization primitives and clock used by a ProcessServer.
+  The simulator swaps in a runtime with the same interface that runs on a
+  virtual clock, so the server logic is shared between both modes.
+  """
+
+  def spawn(self, target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+  def Event(self):
+    return threading.Event()
+
+  def Lock(self):
+    return threading.Lock()
+
+  def Condition(self):
+    return threading.Condition()
+
+  def time(self):
+    return time.time()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
@@ -0,0 +1,189 @@
+import json
+import logging
+import shlex
+import subprocess
+import threading
+import time
+
+# A scenario file is a JSON object:
+#
+# {
+#   "name": "leader crash",
+#   "duration": 120,
+#   "bucket": 5,
+#   "restart_command": "python3 -u process_server.py {node} localhost {port} --log-level ERROR",
+#   "report": "leader_crash.report.json",
+#   "timeline": [
+#     {"at": 1, "node": 0, "client": "create 1"},
+#     {"at": 10, "command": "failNode 0"},
+#     {"at": 40, "command": "restartNode 0"}
+#   ]
+# }
+#
+# Times are seconds from the start of the scenario. "command" entries use the
+# NetworkServer console syntax plus restartNode; "client" entries are handed to
+# the given node as if typed on its console. simulator.py accepts the same files.
+
+def load_scenario(path):
+  with open(path) as f:
+    scenario = json.load(f)
+  scenario["timeline"] = sorted(scenario.get("timeline", []), key=lambda event: event["at"])
+  scenario.setdefault("duration", max([event["at"] for event in scenario["timeline"]], default=0) + 30)
+  return scenario
+
+def commits_in(message):
+  """Commands a leader announces as decided in this message."""
+  if message["header"] in ("ACCEPT", "DECIDE"):
+    return [command for _, command in message.get("commits") or []]
+  return []
+
+class ScenarioRunner:
+  """
+  Replays a scenario against the live NetworkServer and measures how the
+  cluster reacts, by observing the traffic passing through the relay:
+  ACCEPTs reveal the current leader, DECIDEs and piggybacked commits reveal
+  commits, and the commit index carried by each message shows how far a node is.
+  Servers started with --direct bypass the relay, so the NetworkServer
+  refuses to run a scenario while any of them is connected.
+  """
+
+  def __init__(self, network_server, path):
+    self.network_server = network_server
+    self.path = path
+    self.scenario = load_scenario(path)
+    self.lock = threading.Lock()
+    self.start_time = None
+    self.leader = None
+    self.leader_changes = [] # (time, leader)
+    self.commit_times = []
+    self.seen_commits = set()
+    self.commit_indexes = {} # node -> commit index it last reported
+    self.faults = []
+    self.rejoins = []
+    self.restarted = {} # node -> Popen of a restarted process_server
+    self.applied = []
+
+  def now(self):
+    return time.monotonic() - self.start_time
+
+  def start(self):
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def observe(self, server_id, message):
+    with self.lock:
+      t = self.now()
+      if message["header"] == "ACCEPT" and message["src"] != self.leader:
+        self.leader = message["src"]
+        self.leader_changes.append((t, self.leader))
+      for commit in commits_in(message):
+        if commit not in self.seen_commits:
+          self.seen_commits.add(commit)
+          self.commit_times.append(t)
+      self.commit_indexes[server_id] = message.get("commit_index", 0)
+      for rejoin in self.rejoins:
+        if rejoin["node"] != server_id or rejoin["catch_up_seconds"] is not None:
+          continue
+        if rejoin["rejoined_after"] is None:
+          rejoin["rejoined_after"] = t - rejoin["restarted_at"]
+          rejoin["first_message_at"] = t
+        if self.commit_indexes[server_id] >= rejoin["target_index"]:
+          rejoin["catch_up_seconds"] = t - rejoin["first_message_at"]
+
+  def run(self):
+    name = self.scenario.get("name", self.path)
+    logging.info(f"Starting scenario {name}")
+    self.start_time = time.monotonic()
+    self.network_server.observers.append(self.observe)
+    try:
+      for event in self.scenario["timeline"]:
+        delay = event["at"] - self.now()
+        if delay > 0:
+          time.sleep(delay)
+        self.apply(event)
+      remaining = self.scenario["duration"] - self.now()
+      if remaining > 0:
+        time.sleep(remaining)
+    except Exception as e:
+      logging.exception(f"Scenario {name} failed: {e}")
+    finally:
+      self.network_server.observers.remove(self.observe)
+
+    report = self.report()
+    report_path = self.scenario.get("report", f"{self.path}.report.json")
+    with open(report_path, "w") as f:
+      json.dump(report, f, indent=2)
+    logging.info(f"Scenario {name} finished, report written to {report_path}")
+    return report
+
+  def apply(self, event):
+    t = self.now()
+    self.applied.append({"at": event["at"], "applied_at": round(t, 3), **{k: v for k, v in event.items() if k != "at"}})
+    if "client" in event:
+      self.network_server.send_control(event["node"], "CLIENT", event["client"])
+      return
+
+    tokens = event["command"].split()
+    action, args = tokens[0], [int(token) for token in tokens[1:]]
+    if action in ("failLink", "failNode"):
+      with self.lock:
+        self.faults.append({"command": event["command"], "at": t, "leader_before": self.leader})
+    if action == "failLink":
+      self.network_server.failLink(*args)
+    elif action == "fixLink":
+      self.network_server.fixLink(*args)
+    elif action == "failNode":
+      self.network_server.failNode(args[0])
+    elif action == "restartNode":
+      self.restart(args[0], t)
+    else:
+      logging.warning(f"Unknown scenario command: {event['command']}")
+
+  def restart(self, node, t):
+    template = self.scenario.get("restart_command")
+    if not template:
+      logging.error("Scenario has no restart_command, cannot restart node")
+      return
+    command = template.format(node=node, port=self.network_server.server_port)
+    # Keep stdin open, the process server reads commands from it
+    self.restarted[node] = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    with self.lock:
+      others = [index for other, index in self.commit_indexes.items() if other != node]
+      self.rejoins.append({
+        "node": node,
+        "restarted_at": t,
+        "target_index": max(others, default=0),
+        "rejoined_after": None,
+        "first_message_at": None,
+        "catch_up_seconds": None,
+      })
+
+  def report(self):
+    with self.lock:
+      faults = []
+      for fault in self.faults:
+        new_leader = next(((t, leader) for t, leader in self.leader_changes if t > fault["at"] and leader != fault["leader_before"]), None)
+        first_commit = next((t for t in self.commit_times if t > fault["at"]), None)
+        faults.append({
+          "command": fault["command"],
+          "at": round(fault["at"], 3),
+          "leader_before": fault["leader_before"],
+          "new_leader": new_leader[1] if new_leader else None,
+          "time_to_new_leader": round(new_leader[0] - fault["at"], 3) if new_leader else None,
+          "time_to_first_commit": round(first_commit - fault["at"], 3) if first_commit is not None else None,
+        })
+
+      bucket = self.scenario.get("bucket", 5)
+      throughput = [0] * (int(self.scenario["duration"] // bucket) + 1)
+      for t in self.commit_times:
+        throughput[min(int(t // bucket), len(throughput) - 1)] += 1
+
+      return {
+        "name": self.scenario.get("name", self.path),
+        "duration": self.scenario["duration"],
+        "events": self.applied,
+        "commits": len(self.commit_times),
+        "faults": faults,
+        "rejoins": [{k: (round(v, 3) if isinstance(v, float) else v) for k, v in rejoin.items() if k != "first_message_at"} for rejoin in self.rejoins],
+        "leader_changes": [{"at": round(t, 3), "leader": leader} for t, leader in self.leader_changes],
+        "throughput": [{"t": i * bucket, "commits": count, "per_second": round(count / bucket, 3)} for i, count in enumerate(throughput)],
+      }
@@ -0,0 +1,509 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from contextlib import redirect_stdout
+from llm_service import LLMService, percentile
+from network_server import NetworkServer
+from process_server import ProcessServer
+from request_dedup import split_command
+from scenario_runner import load_scenario
+
+# Deterministic single-process cluster simulator.
+#
+# NetworkServer routing and N ProcessServer state machines run over an
+# in-memory transport. Every ProcessServer thread becomes a task of a
+# SimRuntime: tasks are real threads, but only one of them runs at a time and
+# the scheduler picks the next one with a seeded RNG. Blocking calls (sleeps,
+# Event/Condition waits) park the task and hand control back, and timeouts
+# fire on a virtual clock, so a run with 10 s election timeouts and 3 s relay
+# hops takes milliseconds and replays exactly for a given seed.
+
+class SimulationStopped(BaseException):
+  """Raised inside parked tasks to unwind them when a run is torn down."""
+
+class SimTask:
+  def __init__(self, target, args):
+    self.target = target
+    self.args = args
+    self.worker = None
+    self.blocked = False
+    self.token = 0 # bumped on every park so stale wakeups are ignored
+
+class SimWorker:
+  """A real thread that runs tasks for the runtime, one at a time, on demand."""
+
+  def __init__(self, runtime):
+    self.runtime = runtime
+    self.task = None
+    self.resume = threading.Semaphore(0)
+    self.thread = threading.Thread(target=self.loop, daemon=True)
+    self.thread.start()
+
+  def loop(self):
+    while True:
+      self.resume.acquire()
+      task = self.task
+      if task is None:
+        return
+      try:
+        task.target(*task.args)
+      except SimulationStopped:
+        pass
+      except Exception as e:
+        logging.exception(f"Simulated task failed: {e}")
+      finally:
+        task.worker = None
+        self.task = None
+        self.runtime.live_tasks.discard(task)
+        self.runtime.idle_workers.append(self)
+        self.runtime.baton.release()
+
+class SimEvent:
+  def __init__(self, runtime):
+    self.runtime = runtime
+    self.flag = False
+    self.waiters = []
+
+  def is_set(self):
+    return self.flag
+
+  def set(self):
+    self.flag = True
+    waiters, self.waiters = self.waiters, []
+    for task, token in waiters:
+      self.runtime.wake(task, token)
+
+  def clear(self):
+    self.flag = False
+
+  def wait(self, timeout=None):
+    if self.flag:
+      return True
+    self.waiters.append(self.runtime.park())
+    self.runtime.block(timeout)
+    return self.flag
+
+class SimLock:
+  """Lock for tasks; only one task runs at a time and none blocks while holding it, so it is a no-op."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def acquire(self, blocking=True, timeout=-1):
+    return True
+
+  def release(self):
+    pass
+
+class SimCondition:
+  """Condition variable for tasks; only one task runs at a time, so the lock is implicit."""
+
+  def __init__(self, runtime):
+    self.runtime = runtime
+    self.waiters = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def wait(self, timeout=None):
+    self.waiters.append(self.runtime.park())
+    self.runtime.block(timeout)
+    return True
+
+  def wait_for(self, predicate, timeout=None):
+    deadline = None if timeout is None else self.runtime.now + timeout
+    result = predicate()
+    while not result:
+      if deadline is not None:
+        remaining = deadline - self.runtime.now
+        if remaining <= 0:
+          break
+        self.wait(remaining)
+      else:
+        self.wait()
+      result = predicate()
+    return result
+
+  def notify(self, n=1):
+    waiters, self.waiters = self.waiters[:n], self.waiters[n:]
+    for task, token in waiters:
+      self.runtime.wake(task, token)
+
+  def notify_all(self):
+    self.notify(len(self.waiters))
+
+class SimRuntime:
+  """Drop-in replacement for ThreadRuntime driven by a seeded scheduler and a virtual clock."""
+
+  def __init__(self, seed=0):
+    self.now = 0.0
+    self.rng = random.Random(seed)
+    self.timers = [] # heap of (time, seq, callback)
+    self.timer_seq = itertools.count()
+    self.ready = [] # tasks that can run at the current virtual time
+    self.current = None
+    self.baton = threading.Semaphore(0) # released by a task when it parks or finishes
+    self.idle_workers = []
+    self.live_tasks = set() # tasks that have a worker, running or parked
+    self.stopping = False
+
+  # ThreadRuntime interface
+  def spawn(self, target, *args):
+    task = SimTask(target, args)
+    self.ready.append(task)
+    return task
+
+  def Event(self):
+    return SimEvent(self)
+
+  def Lock(self):
+    return SimLock()
+
+  def Condition(self):
+    return SimCondition(self)
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.park()
+    self.block(seconds)
+
+  # Scheduling
+  def call_at(self, when, callback):
+    heapq.heappush(self.timers, (when, next(self.timer_seq), callback))
+
+  def call_later(self, delay, callback):
+    self.call_at(self.now + delay, callback)
+
+  def park(self):
+    """Mark the running task as waiting; returns the handle that wakes it."""
+    task = self.current
+    if task is None:
+      raise RuntimeError("Blocking call outside of a simulated task")
+    task.token += 1
+    task.blocked = True
+    return task, task.token
+
+  def wake(self, task, token):
+    if task.blocked and task.token == token:
+      task.blocked = False
+      self.ready.append(task)
+
+  def block(self, timeout=None):
+    """Hand control back to the scheduler until the parked task is woken."""
+    task = self.current
+    if self.stopping:
+      raise SimulationStopped()
+    if timeout is not None:
+      token = task.token
+      self.call_later(max(0.0, timeout), lambda: self.wake(task, token))
+    self.baton.release()
+    task.worker.resume.acquire()
+    if self.stopping:
+      raise SimulationStopped()
+
+  def switch(self, task):
+    if task.worker is None:
+      worker = self.idle_workers.pop() if self.idle_workers else SimWorker(self)
+      worker.task = task
+      task.worker = worker
+      self.live_tasks.add(task)
+    self.current = task
+    task.worker.resume.release()
+    self.baton.acquire()
+    self.current = None
+
+  def run(self, until):
+    """Run tasks and fire timers until the virtual clock would pass until."""
+    while True:
+      if self.ready:
+        self.switch(self.ready.pop(self.rng.randrange(len(self.ready))))
+      elif self.timers and self.timers[0][0] <= until:
+        when, _, callback = heapq.heappop(self.timers)
+        self.now = max(self.now, when)
+        callback()
+      else:
+        break
+    self.now = max(self.now, until)
+
+  def close(self):
+    """Unwind every parked task and stop the worker threads."""
+    self.stopping = True
+    self.ready.clear()
+    self.timers.clear()
+    for task in list(self.live_tasks):
+      self.switch(task)
+    for worker in self.idle_workers:
+      worker.task = None
+      worker.resume.release()
+      worker.thread.join()
+    self.idle_workers.clear()
+
+class SimTransport:
+  """Stands in for a process' OutboundQueue, routing frames through the simulated relay."""
+
+  def __init__(self, cluster, process):
+    self.cluster = cluster
+    self.process = process
+
+  def send(self, dest, *parts):
+    if dest == -1:
+      return # HELLO to the relay, compression is off in simulation
+    self.cluster.route(self.process, json.loads(b"".join(bytes(part) for part in parts)))
+
+  def close(self, timeout=None):
+    pass
+
+class SimLLMService(LLMService):
+  """LLMService whose model calls take a random virtual-time latency."""
+
+  def __init__(self, runtime, rng, latency=(0.5, 2.0)):
+    super().__init__("simulated")
+    self.runtime = runtime
+    self.rng = rng
+    self.latency = latency
+    self.clock = runtime.time
+    self.sleep = runtime.sleep
+
+  def hedged_call(self, prompt, timeout):
+    latency = self.rng.uniform(*self.latency)
+    if latency > timeout:
+      self.runtime.sleep(timeout)
+      raise TimeoutError("Simulated LLM call timed out")
+    self.runtime.sleep(latency)
+    self.record(self.latencies, latency)
+    return f"Simulated answer {zlib.crc32(prompt.encode('utf-8')):08x}"
+
+class SimProcessServer(ProcessServer):
+  def __init__(self, cluster, id, incarnation):
+    super().__init__(id, "simulated", 0, compression=False, runtime=cluster.runtime,
+                     service=SimLLMService(cluster.runtime, cluster.rng))
+    self.cluster = cluster
+    self.client_id = f"{id}.{incarnation}" # deterministic across runs with the same seed
+    self.num_nodes = cluster.num_nodes
+    self.majority = self.num_nodes // 2
+
+  def decide(self, message, src, ballot_number, is_leader=False):
+    applied = super().decide(message, src, ballot_number, is_leader)
+    meta, _ = split_command(message)
+    if applied and "rid" in meta:
+      self.cluster.record_decide(meta["rid"])
+    return applied
+
+class SimCluster:
+  """NetworkServer routing plus N ProcessServers sharing one SimRuntime."""
+
+  def __init__(self, num_nodes=3, seed=0, delay=None, jitter=0.2):
+    self.num_nodes = num_nodes
+    self.runtime = SimRuntime(seed)
+    self.rng = self.runtime.rng
+    self.jitter = jitter
+    self.network = NetworkServer(0, num_nodes)
+    if delay is not None:
+      self.network.delay = delay
+    for src, dest in itertools.combinations(range(num_nodes), 2):
+      self.network.fixLink(src, dest)
+
+    self.processes = {} # node id -> live SimProcessServer
+    self.incarnations = [] # every SimProcessServer ever started
+    self.submitted = {} # request id -> virtual submit time
+    self.decided = {} # request id -> virtual time of its first decide
+    self.faults = [] # (virtual time, fault command)
+    self.counters = {"messages": 0, "dropped": 0, "rejected": 0}
+    for node in range(num_nodes):
+      self.start_node(node)
+
+  def start_node(self, node):
+    process = SimProcessServer(self, node, len(self.incarnations))
+    process.outbound = SimTransport(self, process)
+    self.processes[node] = process
+    self.incarnations.append(process)
+    self.runtime.spawn(process.handle_consensus)
+    self.runtime.spawn(process.apply_commits)
+
+  def route(self, sender, message):
+    src, dest = message["src"], message["dest"]
+    if self.processes.get(src) is not sender:
+      return # a crashed incarnation is still unwinding
+    if dest not in self.processes or not self.network.can_forward(src, dest):
+      self.counters["dropped"] += 1
+      return
+    self.counters["messages"] += 1
+    delay = self.network.delay * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+    self.runtime.call_later(delay, lambda: self.deliver(dest, message))
+
+  def deliver(self, dest, message):
+    process = self.processes.get(dest)
+    if process is not None:
+      self.runtime.spawn(process.handle_message, message)
+
+  def record_decide(self, request_id):
+    self.decided.setdefault(request_id, self.runtime.now)
+
+  def submit(self, node, command):
+    process = self.processes.get(node)
+    if process is None:
+      self.counters["rejected"] += 1
+      return
+    self.submitted[process.submit(command)] = self.runtime.now
+
+  def apply(self, command):
+    """Apply a NetworkServer style fault command: failLink, fixLink, failNode or restartNode."""
+    tokens = command.split()
+    action, args = tokens[0], [int(token) for token in tokens[1:]]
+    if action == "failLink":
+      self.network.failLink(*args)
+    elif action == "fixLink":
+      self.network.fixLink(*args)
+    elif action == "failNode":
+      process = self.processes.pop(args[0], None)
+      if process is not None:
+        kill = {"header": "KILL", "message": "", "ballot_number": (-1, -1, -1), "dest": args[0], "src": -1, "context_id": -1, "contexts": {}}
+        self.runtime.spawn(process.handle_message, kill)
+    elif action == "restartNode":
+      if args[0] not in self.processes:
+        for node in self.processes:
+          self.network.fixLink(args[0], node)
+        self.start_node(args[0])
+    else:
+      raise ValueError(f"Unknown fault command: {command}")
+    if action in ("failLink", "failNode"):
+      self.faults.append((self.runtime.now, command))
+
+  def schedule(self, timeline):
+    for event in timeline:
+      if "command" in event:
+        self.runtime.call_at(event["at"], lambda command=event["command"]: self.apply(command))
+      else:
+        self.runtime.call_at(event["at"], lambda event=event: self.submit(event["node"], event["client"]))
+
+  def run(self, timeline, duration):
+    self.schedule(timeline)
+    self.runtime.run(until=duration)
+    return self.stats(duration)
+
+  def stats(self, duration):
+    latencies = [self.decided[rid] - submitted for rid, submitted in self.submitted.items() if rid in self.decided]
+    commit_times = sorted(self.decided.values())
+    recovery = []
+    for fault_time, _ in self.faults:
+      later = [t for t in commit_times if t > fault_time]
+      recovery.append(later[0] - fault_time if later else None)
+    snapshots = {json.dumps(process.service.get_all_contexts(), sort_keys=True) for process in self.processes.values()}
+    return {
+      "submitted": len(self.submitted),
+      "committed": len(self.decided),
+      "throughput": len(self.decided) / duration,
+      "latency_p50": percentile(latencies, 50),
+      "latency_p99": percentile(latencies, 99),
+      "recovery": recovery,
+      "diverged": len(snapshots) > 1,
+      **self.counters,
+    }
+
+  def close(self):
+    self.runtime.close()
+    for process in self.incarnations:
+      process.service.close()
+
+def random_timeline(rng, num_nodes, duration, load_interval=5.0, max_faults=3):
+  """A random client load plus partition and crash/restart faults, in the scenario file format."""
+  timeline = []
+  contexts = [str(context_id) for context_id in range(1, 4)]
+  for index, context_id in enumerate(contexts):
+    timeline.append({"at": 1.0 + index, "node": rng.randrange(num_nodes), "client": f"create {context_id}"})
+
+  t, query = 5.0, 0
+  while t < duration * 0.8:
+    query += 1
+    timeline.append({"at": round(t, 3), "node": rng.randrange(num_nodes), "client": f"query {rng.choice(contexts)} q{query}"})
+    t += rng.expovariate(1 / load_interval)
+
+  for _ in range(rng.randint(0, max_faults)):
+    start = round(rng.uniform(10.0, duration * 0.6), 3)
+    end = round(start + rng.uniform(5.0, duration * 0.3), 3)
+    if rng.random() < 0.5:
+      src, dest = rng.sample(range(num_nodes), 2)
+      timeline.append({"at": start, "command": f"failLink {src} {dest}"})
+      timeline.append({"at": end, "command": f"fixLink {src} {dest}"})
+    else:
+      node = rng.randrange(num_nodes)
+      timeline.append({"at": start, "command": f"failNode {node}"})
+      timeline.append({"at": end, "command": f"restartNode {node}"})
+  return sorted(timeline, key=lambda event: event["at"])
+
+def simulate(seed, num_nodes=3, duration=120.0, delay=None, timeline=None):
+  """Run one simulated cluster and return its stats."""
+  cluster = SimCluster(num_nodes, seed, delay)
+  try:
+    if timeline is None:
+      timeline = random_timeline(random.Random(seed), num_nodes, duration)
+    return cluster.run(timeline, duration)
+  finally:
+    cluster.close()
+
+def summarize(results):
+  latencies_p50 = [r["latency_p50"] for r in results if r["latency_p50"] is not None]
+  latencies_p99 = [r["latency_p99"] for r in results if r["latency_p99"] is not None]
+  recovery = [t for r in results for t in r["recovery"]]
+  recovered = [t for t in recovery if t is not None]
+  return {
+    "runs": len(results),
+    "throughput_mean": sum(r["throughput"] for r in results) / len(results),
+    "commit_rate": sum(r["committed"] for r in results) / max(1, sum(r["submitted"] for r in results)),
+    "latency_p50": percentile(latencies_p50, 50),
+    "latency_p99": percentile(latencies_p99, 99),
+    "faults": len(recovery),
+    "recovery_p50": percentile(recovered, 50),
+    "recovery_p99": percentile(recovered, 99),
+    "unrecovered": len(recovery) - len(recovered),
+    "diverged_runs": sum(r["diverged"] for r in results),
+  }
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Deterministic simulation of the Paxos cluster on a virtual clock.")
+  parser.add_argument("--runs", type=int, default=100, help="Number of randomized runs")
+  parser.add_argument("--seed", type=int, default=0, help="Seed of the first run, run i uses seed + i")
+  parser.add_argument("--nodes", type=int, default=3, help="Number of ProcessServers")
+  parser.add_argument("--duration", type=float, default=120.0, help="Virtual seconds per run")
+  parser.add_argument("--delay", type=float, default=None, help="Relay delay per hop, defaults to the NetworkServer's")
+  parser.add_argument("--timeline", help="Replay this scenario file instead of random schedules")
+  parser.add_argument("--per-run", action="store_true", help="Include every run's stats in the output")
+  return parser.parse_args()
+
+if __name__ == "__main__":
+  args = parse_args()
+  logging.disable(logging.CRITICAL)
+
+  timeline = None
+  if args.timeline:
+    timeline = load_scenario(args.timeline)["timeline"]
+
+  started = time.time()
+  results = []
+  # Servers print every message they handle, keep that out of the report
+  with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+    for run in range(args.runs):
+      results.append(simulate(args.seed + run, args.nodes, args.duration, args.delay, timeline))
+
+  report = summarize(results)
+  report["wall_seconds"] = round(time.time() - started, 3)
+  if args.per_run:
+    report["per_run"] = results
+  json.dump(report, sys.stdout, indent=2)
+  print()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from context_store import TieredContextStore
+
+class TestTieredContextStore(unittest.TestCase):
+    def setUp(self):
+        self.store = TieredContextStore(budget_bytes=100)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_evicts_least_recently_used(self):
+        self.store["1"] = "a" * 60
+        self.store["2"] = "b" * 60
+        self.assertIn("1", self.store.cold)
+        self.assertIn("2", self.store.hot)
+        self.assertLessEqual(self.store.hot_bytes, 100)
+
+        self.assertEqual(self.store.peek("1"), "a" * 60)
+        self.assertIn("1", self.store.cold)
+
+        self.assertEqual(self.store.get("1"), "a" * 60)
+        self.assertIn("1", self.store.hot)
+        self.assertIn("2", self.store.cold)
+
+    def test_budget_counts_utf8_bytes(self):
+        self.store["1"] = "\u00e9" * 30
+        self.assertEqual(self.store.sizes(), {"1": 60})
+        self.assertEqual(self.store.hot_bytes, 60)
+        self.store["2"] = "\u00e9" * 30
+        self.assertIn("1", self.store.cold)
+        self.assertEqual(self.store.hot_bytes, 60)
+        self.assertEqual(self.store.sizes(), {"1": 60, "2": 60})
+
+    def test_copy_includes_cold_contexts(self):
+        for i in range(10):
+            self.store[str(i)] = f"Query: {i}" * 5
+        self.assertEqual(len(self.store), 10)
+        self.assertEqual(self.store.copy(), {str(i): f"Query: {i}" * 5 for i in range(10)})
+
+    def test_compaction_keeps_latest_values(self):
+        for round in range(200):
+            for i in range(4):
+                self.store[str(i)] = f"{round}:" + "x" * 2000
+        self.assertLess(self.store.segment.tell(), 2 * 1024 * 1024)
+        for i in range(4):
+            self.assertEqual(self.store.get(str(i)), "199:" + "x" * 2000)
+
+    def test_reopened_segment_recovers_contexts(self):
+        path = os.path.join(tempfile.mkdtemp(), "contexts.seg")
+        store = TieredContextStore(budget_bytes=100, segment_path=path)
+        store["1"] = "a" * 60
+        store["2"] = "b" * 60
+        store["1"] = "c" * 10
+        store.close()
+
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x00\x01") # torn record header
+        store = TieredContextStore(budget_bytes=100, segment_path=path)
+        self.assertEqual(store.copy(), {"1": "c" * 10, "2": "b" * 60})
+        self.assertEqual(store.preload(), 2)
+        self.assertEqual(set(store.hot), {"1", "2"})
+        store.close()
+        os.remove(path)
+
+    def test_updates_are_written_through_without_close(self):
+        path = os.path.join(tempfile.mkdtemp(), "contexts.seg")
+        store = TieredContextStore(budget_bytes=100, segment_path=path)
+        store["1"] = "a" * 60
+        store["2"] = "b" * 10
+        store["2"] += "c" * 10
+        # Simulate a crash: the segment is never closed
+        recovered = TieredContextStore(budget_bytes=100, segment_path=path)
+        self.assertEqual(recovered.copy(), {"1": "a" * 60, "2": "b" * 10 + "c" * 10})
+        recovered.close()
+        store.close()
+        os.remove(path)
+
+    def test_evicting_a_flushed_context_does_not_rewrite_it(self):
+        path = os.path.join(tempfile.mkdtemp(), "contexts.seg")
+        store = TieredContextStore(budget_bytes=100, segment_path=path)
+        store["1"] = "a" * 60
+        written = store.segment.tell()
+        store["2"] = "b" * 60
+        self.assertIn("1", store.cold)
+        self.assertEqual(store.segment.tell(), written + 8 + 1 + 60)
+        self.assertEqual(store.get("1"), "a" * 60)
+        self.assertEqual(store.segment.tell(), written + 8 + 1 + 60)
+        self.assertIn("2", store.cold)
+        store.close()
+        os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
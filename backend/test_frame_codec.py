@@ -0,0 +1,59 @@
+import os
+import unittest
+import frame_codec
+from frame_codec import FrameCodec, SharedPayload
+
+class TestFrameCodec(unittest.TestCase):
+    def setUp(self):
+        self.sender = FrameCodec(threshold=64)
+        self.receiver = FrameCodec(threshold=64)
+        self.sender.enable(frame_codec.offer())
+        self.receiver.enable(frame_codec.offer())
+
+    def roundtrip(self, parts):
+        prefix, *body = self.sender.encode(parts)
+        length, compressed = frame_codec.parse_prefix(prefix)
+        payload = b"".join(body)
+        self.assertEqual(length, len(payload))
+        return self.receiver.decode(payload, compressed), compressed
+
+    def test_compresses_text(self):
+        text = b'{"contexts": {"1": "' + b"Query: What is the difference between A and B?\\nAnswer: The main difference is that " * 20 + b'"'
+        data, compressed = self.roundtrip([text, b', "dest": 1}'])
+        self.assertTrue(compressed)
+        self.assertEqual(data, text + b', "dest": 1}')
+        self.assertGreater(self.sender.stats()["ratio"], 5)
+
+    def test_skips_small_and_incompressible(self):
+        self.assertEqual(self.roundtrip([b"tiny"]), (b"tiny", False))
+        noise = os.urandom(4096)
+        self.assertEqual(self.roundtrip([noise]), (noise, False))
+        stats = self.sender.stats()
+        self.assertEqual(stats["skipped_small"], 1)
+        self.assertEqual(stats["skipped_incompressible"], 1)
+
+    def test_disabled_until_negotiated(self):
+        codec = FrameCodec(threshold=0)
+        prefix, body = codec.encode([b"x" * 4096])
+        self.assertEqual(frame_codec.parse_prefix(prefix), (4096, False))
+
+    def test_decodes_before_negotiation(self):
+        # A frame compressed with the preset dictionary reaches a codec that has not seen the peer's HELLO yet
+        text = b"Query: Can you explain how \nAnswer: Sure! Here is an explanation of how it works:" * 10
+        prefix, *body = self.sender.encode([text])
+        self.assertEqual(FrameCodec().decode(b"".join(body), frame_codec.parse_prefix(prefix)[1]), text)
+
+    def test_shared_payload_is_compressed_once(self):
+        shared = SharedPayload(b'{"header": "ACCEPT", "contexts": {"1": "' + b"Query: Why does \nAnswer: There are several reasons" * 30 + b'"}')
+        for dest in range(3):
+            tail = f', "dest": {dest}}}'.encode('utf-8')
+            data, compressed = self.roundtrip([shared, tail])
+            self.assertTrue(compressed)
+            self.assertEqual(data, shared.data + tail)
+        self.assertEqual(self.sender.stats()["shared_reused"], 2)
+
+        small = SharedPayload(b"tiny")
+        self.assertEqual(self.roundtrip([small, b"!"]), (b"tiny!", False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import threading
+import time
 import unittest
 from llm_service import LLMService
 import os
@@ -51,5 +53,101 @@ class TestLLMService(unittest.TestCase):
         self.assertIn("test5a", contexts)
         self.assertIn("test5b", contexts)
 
+class TestGenerateResponse(unittest.TestCase):
+    """Retries, hedging and deadlines, with call_model stubbed out."""
+
+    def setUp(self):
+        self.service = LLMService("unused", hedge_initial_delay=5.0, backoff_base=0.01)
+        self.service.create_context("1")
+        self.service.add_query_to_context("1", "What is 2+2?")
+        self.sleeps = []
+        self.service.sleep = self.sleeps.append
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.service.close()
+
+    def stub(self, *outcomes):
+        """Each call takes the next outcome: an exception is raised, a callable is run, anything else returned."""
+        calls = []
+        def call_model(prompt, timeout):
+            outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+            calls.append(prompt)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return outcome() if callable(outcome) else outcome
+        self.service.call_model = call_model
+        return calls
+
+    def test_hedged_call_returns_the_faster_attempt(self):
+        self.service.hedge_initial_delay = 0.05
+        calls = self.stub(lambda: self.release.wait(2) and "slow", "fast")
+        self.assertEqual(self.service.generate_response("1"), "fast")
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(calls[0].endswith("Query: What is 2+2?\nAnswer: "))
+        metrics = self.service.get_metrics()
+        self.assertEqual((metrics["hedged"], metrics["hedge_wins"]), (1, 1))
+
+    def test_transient_errors_are_retried_with_backoff(self):
+        calls = self.stub(ConnectionError("reset"), TimeoutError("slow"), "4")
+        self.assertEqual(self.service.generate_response("1"), "4")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        for attempt, backoff in enumerate(self.sleeps):
+            base = self.service.backoff_base * 2 ** attempt
+            self.assertTrue(0.5 * base <= backoff <= 1.5 * base)
+        self.assertEqual(self.service.get_metrics()["retries"], 2)
+
+    def test_retries_stop_after_max_retries(self):
+        calls = self.stub(ConnectionError("reset"))
+        self.assertIsNone(self.service.generate_response("1"))
+        self.assertEqual(len(calls), self.service.max_retries + 1)
+        self.assertEqual(self.service.get_metrics()["failures"], 1)
+
+    def test_deadline_expiry_returns_none(self):
+        self.stub(lambda: self.release.wait(2) and "late")
+        start = time.monotonic()
+        self.assertIsNone(self.service.generate_response("1", deadline=time.time() + 0.2))
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(self.service.get_metrics()["failures"], 1)
+
+    def test_other_errors_fail_without_retry(self):
+        calls = self.stub(ValueError("blocked prompt"))
+        self.assertIsNone(self.service.generate_response("1"))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(self.service.get_metrics()["failures"], 1)
+
+    def test_unknown_context_is_not_sent(self):
+        calls = self.stub("x")
+        self.assertIsNone(self.service.generate_response("missing"))
+        self.assertEqual(calls, [])
+
+    def test_metrics_report_latency_and_hedge_rate(self):
+        self.stub("4")
+        for _ in range(4):
+            self.service.generate_response("1")
+        metrics = self.service.get_metrics()
+        self.assertEqual(metrics["requests"], 4)
+        self.assertEqual(metrics["hedge_rate"], 0.0)
+        self.assertIsNotNone(metrics["p50"])
+        self.assertIsNotNone(metrics["p99_unhedged"])
+        self.assertIn("p99_improvement", metrics)
+
+class TestClosedService(unittest.TestCase):
+    def test_calls_after_close_fail_quietly(self):
+        service = LLMService("unused")
+        service.create_context("1")
+        service.close()
+        self.assertFalse(service.create_context("2"))
+        self.assertFalse(service.add_query_to_context("1", "late"))
+        self.assertFalse(service.save_answer("1", "late"))
+        self.assertIsNone(service.generate_response("1"))
+        self.assertIsNone(service.get_context("1"))
+        self.assertEqual(service.get_all_contexts(), {})
+        self.assertEqual(service.get_context_sizes(), {})
+        service.compare_and_update_dict({"1": "Query: late"})
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
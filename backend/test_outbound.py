@@ -0,0 +1,102 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+from outbound import OutboundQueue
+
+def read_frames(sock, count):
+    frames = []
+    buffer = b""
+    while len(frames) < count:
+        while len(buffer) < 4 or len(buffer) < 4 + struct.unpack('>I', buffer[:4])[0]:
+            buffer += sock.recv(65536)
+        length = struct.unpack('>I', buffer[:4])[0]
+        frames.append(buffer[4:4 + length])
+        buffer = buffer[4 + length:]
+    return frames
+
+class TrickleSocket:
+    """Accepts at most a few bytes per sendmsg, optionally holding the first write until released."""
+
+    def __init__(self, chunk=3, hold=False):
+        self.chunk = chunk
+        self.data = bytearray()
+        self.calls = []
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def sendmsg(self, buffers):
+        self.release.wait()
+        data = b"".join(bytes(buffer) for buffer in buffers)
+        self.calls.append(data)
+        sent = data[:self.chunk]
+        self.data.extend(sent)
+        return len(sent)
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_frames_arrive_over_a_socket(self):
+        left, right = socket.socketpair()
+        queue = OutboundQueue(left, name="test")
+        shared = b'{"header": "ACCEPT"'
+        for dest in range(3):
+            queue.send(dest, shared, f', "dest": {dest}}}'.encode('utf-8'))
+        self.assertTrue(queue.flush(timeout=2))
+        self.assertEqual(read_frames(right, 3), [shared + f', "dest": {dest}}}'.encode('utf-8') for dest in range(3)])
+        queue.close()
+        left.close()
+        right.close()
+
+    def test_partial_writes_are_resumed(self):
+        sock = TrickleSocket(chunk=3)
+        queue = OutboundQueue(sock, name="trickle")
+        queue.send(0, b"hello ", b"world")
+        self.assertTrue(queue.flush(timeout=2))
+        self.assertEqual(bytes(sock.data), struct.pack('>I', 11) + b"hello world")
+        queue.close()
+
+    def test_destinations_are_drained_round_robin_in_one_write(self):
+        sock = TrickleSocket(chunk=1 << 20, hold=True)
+        queue = OutboundQueue(sock, name="batch")
+        queue.send(0, b"first")
+        # The writer is now stuck in sendmsg with "first", the rest queue up behind it
+        while queue.ready:
+            time.sleep(0.001)
+        for payload in (b"a1", b"a2", b"a3"):
+            queue.send(1, payload)
+        for payload in (b"b1", b"b2"):
+            queue.send(2, payload)
+        sock.release.set()
+        self.assertTrue(queue.flush(timeout=2))
+        self.assertEqual(len(sock.calls), 2)
+        frames = sock.calls[1].split(struct.pack('>I', 2))[1:]
+        self.assertEqual(frames, [b"a1", b"b1", b"a2", b"b2", b"a3"])
+        queue.close()
+
+    def test_close_writes_queued_frames_then_drops_new_ones(self):
+        left, right = socket.socketpair()
+        queue = OutboundQueue(left, name="closing")
+        for i in range(100):
+            queue.send(i % 4, b"x" * 100)
+        queue.close(timeout=2)
+        self.assertEqual(len(read_frames(right, 100)), 100)
+        queue.send(0, b"late")
+        self.assertEqual(queue.pending, 0)
+        queue.writer.join(timeout=2)
+        self.assertFalse(queue.writer.is_alive())
+        left.close()
+        right.close()
+
+    def test_write_error_closes_the_queue(self):
+        left, right = socket.socketpair()
+        right.close()
+        queue = OutboundQueue(left, name="broken")
+        for _ in range(50):
+            queue.send(0, b"x" * 65536)
+        self.assertTrue(queue.flush(timeout=2))
+        self.assertTrue(queue.closed)
+        left.close()
+
+if __name__ == '__main__':
+    unittest.main()
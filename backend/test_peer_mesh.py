@@ -0,0 +1,70 @@
+import json
+import queue
+import random
+import threading
+import time
+import unittest
+from peer_mesh import PeerMesh
+
+class TestPeerMesh(unittest.TestCase):
+    def setUp(self):
+        base_port = random.randint(20000, 40000)
+        self.received = {0: queue.Queue(), 1: queue.Queue()}
+        self.meshes = [PeerMesh(node, 2, "localhost", base_port, self.deliver(node)) for node in range(2)]
+        for mesh in self.meshes:
+            mesh.RETRY_INTERVAL = 0.05
+            mesh.start()
+            mesh.update_links([True, True], 0)
+        for _ in range(100):
+            if all(mesh.stats()["peers"] for mesh in self.meshes):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        for mesh in self.meshes:
+            mesh.close()
+
+    def deliver(self, node):
+        def on_message(message):
+            self.received[node].put(message)
+            return True
+        return on_message
+
+    def frame(self, src, dest, text):
+        return json.dumps({"header": "ACCEPT", "message": text, "src": src, "dest": dest}).encode('utf-8')
+
+    def test_messages_go_directly_to_the_peer(self):
+        self.assertTrue(self.meshes[0].send(1, self.frame(0, 1, "x" * 5000)))
+        self.assertEqual(self.received[1].get(timeout=2)["message"], "x" * 5000)
+        self.assertTrue(self.meshes[1].send(0, self.frame(1, 0, "back")))
+        self.assertEqual(self.received[0].get(timeout=2)["message"], "back")
+
+    def test_failed_link_drops_messages(self):
+        for mesh in self.meshes:
+            mesh.update_links([False, False], 0)
+        self.assertTrue(self.meshes[0].send(1, self.frame(0, 1, "lost")))
+        with self.assertRaises(queue.Empty):
+            self.received[1].get(timeout=0.2)
+        self.assertEqual(self.meshes[0].stats()["dropped"], 1)
+
+    def test_delayed_messages_arrive_late_and_in_order(self):
+        self.meshes[0].update_links([True, True], 0.2)
+        threads = threading.active_count()
+        start = time.monotonic()
+        for i in range(20):
+            self.assertTrue(self.meshes[0].send(1, self.frame(0, 1, str(i))))
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual([self.received[1].get(timeout=2)["message"] for _ in range(20)], [str(i) for i in range(20)])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        # Dropping the delay does not let new frames overtake held ones
+        self.meshes[0].send(1, self.frame(0, 1, "held"))
+        self.meshes[0].update_links([True, True], 0)
+        self.meshes[0].send(1, self.frame(0, 1, "immediate"))
+        self.assertEqual([self.received[1].get(timeout=2)["message"] for _ in range(2)], ["held", "immediate"])
+
+    def test_unknown_peer_falls_back_to_relay(self):
+        self.assertFalse(self.meshes[0].send(2, self.frame(0, 2, "relay")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from request_dedup import RequestDedupTable, make_request_id, split_command, tag_command
+
+class TestRequestDedup(unittest.TestCase):
+    def setUp(self):
+        self.table = RequestDedupTable(window=4, max_clients=2)
+
+    def test_tag_and_split(self):
+        message = tag_command("query 1 what is  2+2", rid=make_request_id("0.abc", 3))
+        meta, body = split_command(message)
+        self.assertEqual(meta, {"rid": "0.abc:3"})
+        self.assertEqual(body, "query 1 what is  2+2")
+
+        self.assertEqual(split_command("create 1"), ({}, "create 1"))
+
+    def test_retry_returns_cached_result(self):
+        self.assertEqual(self.table.begin("0.abc:1"), (False, None))
+        self.assertEqual(self.table.begin("0.abc:1"), (True, None))
+        self.table.complete("0.abc:1", "4")
+        self.assertEqual(self.table.begin("0.abc:1"), (True, "4"))
+
+    def test_aborted_request_can_be_retried(self):
+        self.assertEqual(self.table.begin("0.abc:1"), (False, None))
+        self.table.abort("0.abc:1")
+        self.assertEqual(self.table.begin("0.abc:1"), (False, None))
+        self.table.complete("0.abc:1", "done")
+        self.table.abort("0.abc:1")
+        self.assertEqual(self.table.begin("0.abc:1"), (True, "done"))
+
+    def test_snapshot_restores_applied_requests(self):
+        self.table.begin("0.abc:1")
+        self.table.complete("0.abc:1", "4")
+        self.table.begin("0.abc:2")
+        snapshot = self.table.snapshot()
+        self.assertEqual(snapshot, {"0.abc": [2, [1]]})
+
+        other = RequestDedupTable(window=4, max_clients=2)
+        other.begin("1.def:1")
+        other.restore(snapshot)
+        self.assertEqual(other.begin("0.abc:1"), (True, None))
+        self.assertEqual(other.begin("0.abc:2"), (False, None))
+        self.assertEqual(other.begin("1.def:1"), (False, None))
+
+    def test_window_slides(self):
+        for seq in range(1, 7):
+            self.assertFalse(self.table.begin(f"0.abc:{seq}")[0])
+        self.assertEqual(self.table.begin("0.abc:2"), (True, None))
+        self.assertLessEqual(len(self.table.clients["0.abc"]["results"]), 4)
+
+    def test_clients_are_bounded(self):
+        for client in ("a", "b", "c"):
+            self.table.begin(f"{client}:1")
+        self.assertNotIn("a", self.table.clients)
+        self.assertEqual(len(self.table.clients), 2)
+
+if __name__ == '__main__':
+    unittest.main()
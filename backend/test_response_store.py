@@ -0,0 +1,41 @@
+import threading
+import unittest
+from response_store import ResponseStore
+
+class TestResponseStore(unittest.TestCase):
+    def setUp(self):
+        self.store = ResponseStore(max_entries=2)
+
+    def test_put_and_get_by_digest(self):
+        digest = self.store.put("1", 0, "an  answer\n")
+        self.assertEqual(digest, ResponseStore.digest("an  answer\n"))
+        self.assertEqual(self.store.get("1", 0, digest), "an  answer\n")
+        self.assertEqual(self.store.get(1, "0", digest), "an  answer\n")
+        self.assertIsNone(self.store.get("1", 1, digest))
+
+    def test_oldest_entries_are_evicted(self):
+        first = self.store.put("1", 0, "a")
+        self.store.put("1", 1, "b")
+        self.store.get("1", 0, first)
+        self.store.put("1", 0, "a") # refreshes the first entry
+        self.store.put("1", 2, "c")
+        self.assertEqual(self.store.get("1", 0, first), "a")
+        self.assertIsNone(self.store.get("1", 1, ResponseStore.digest("b")))
+
+    def test_put_verified_rejects_mismatched_digest(self):
+        digest = ResponseStore.digest("real")
+        self.assertFalse(self.store.put_verified("1", 0, digest, "forged"))
+        self.assertIsNone(self.store.get("1", 0, digest))
+        self.assertTrue(self.store.put_verified("1", 0, digest, "real"))
+        self.assertEqual(self.store.get("1", 0, digest), "real")
+
+    def test_wait_for_returns_when_the_blob_arrives(self):
+        digest = ResponseStore.digest("late")
+        timer = threading.Timer(0.05, self.store.put, args=("1", 0, "late"))
+        timer.start()
+        self.assertEqual(self.store.wait_for("1", 0, digest, timeout=2), "late")
+        self.assertIsNone(self.store.wait_for("1", 0, "missing", timeout=0.01))
+        timer.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from scenario_runner import ScenarioRunner, load_scenario
+
+class FakeNetworkServer:
+    def __init__(self):
+        self.server_port = 9000
+        self.observers = []
+        self.calls = []
+
+    def send_control(self, dest_id, header, content="", **extra):
+        self.calls.append((header, dest_id, content))
+        return True
+
+    def failLink(self, src, dest):
+        self.calls.append(("failLink", src, dest))
+
+    def fixLink(self, src, dest):
+        self.calls.append(("fixLink", src, dest))
+
+    def failNode(self, node):
+        self.calls.append(("failNode", node))
+
+def message(header, src, commits=None, commit_index=0):
+    return {"header": header, "src": src, "message": "", "commits": commits, "commit_index": commit_index}
+
+class TestScenarioRunner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "scenario.json")
+        scenario = {
+            "name": "leader crash",
+            "duration": 0.3,
+            "bucket": 0.1,
+            "report": os.path.join(self.dir.name, "report.json"),
+            "timeline": [
+                {"at": 0.2, "command": "failNode 0"},
+                {"at": 0.0, "node": 1, "client": "create 1"},
+                {"at": 0.1, "command": "failLink 1 2"},
+            ],
+        }
+        with open(self.path, "w") as f:
+            json.dump(scenario, f)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_timeline_is_sorted(self):
+        self.assertEqual([event["at"] for event in load_scenario(self.path)["timeline"]], [0.0, 0.1, 0.2])
+
+    def test_events_are_applied_and_reported(self):
+        network = FakeNetworkServer()
+        runner = ScenarioRunner(network, self.path)
+        runner.run()
+        self.assertEqual(network.calls, [("CLIENT", 1, "create 1"), ("failLink", 1, 2), ("failNode", 0)])
+        self.assertEqual(network.observers, [])
+        with open(os.path.join(self.dir.name, "report.json")) as f:
+            report = json.load(f)
+        self.assertEqual([fault["command"] for fault in report["faults"]], ["failLink 1 2", "failNode 0"])
+
+    def test_leader_change_and_commits_after_fault(self):
+        runner = ScenarioRunner(FakeNetworkServer(), self.path)
+        runner.start_time = 0
+        runner.now = lambda: now
+        now = 1.0
+        runner.observe(0, message("ACCEPT", 0, commits=[[1, "#rid=a:1 create 1"]]))
+        runner.faults.append({"command": "failNode 0", "at": 2.0, "leader_before": 0})
+        now = 5.0
+        runner.observe(1, message("ACCEPT", 1))
+        now = 6.0
+        runner.observe(2, message("DECIDE", 1, commits=[[1, "#rid=a:1 create 1"], [2, "#rid=a:2 query 1 hi"]]))
+        report = runner.report()
+        self.assertEqual(report["commits"], 2)
+        fault = report["faults"][0]
+        self.assertEqual((fault["new_leader"], fault["time_to_new_leader"], fault["time_to_first_commit"]), (1, 3.0, 4.0))
+
+    def test_restarted_node_catches_up_to_the_commit_index(self):
+        runner = ScenarioRunner(FakeNetworkServer(), self.path)
+        runner.scenario["restart_command"] = "python3 process_server.py {node} localhost {port}"
+        runner.start_time = 0
+        runner.now = lambda: now
+        now = 1.0
+        runner.observe(1, message("ACCEPTED", 1, commit_index=4))
+        runner.observe(2, message("ACCEPTED", 2, commit_index=5))
+        with mock.patch("scenario_runner.subprocess.Popen") as popen:
+            runner.restart(0, 2.0)
+        self.assertEqual(popen.call_args[0][0], ["python3", "process_server.py", "0", "localhost", "9000"])
+        now = 3.5
+        runner.observe(0, message("ACCEPTED", 0, commit_index=0))
+        now = 6.0
+        runner.observe(0, message("ACCEPTED", 0, commit_index=3))
+        now = 7.5
+        runner.observe(0, message("ACCEPTED", 0, commit_index=5))
+        rejoin = runner.report()["rejoins"][0]
+        self.assertEqual((rejoin["node"], rejoin["target_index"]), (0, 5))
+        self.assertEqual((rejoin["rejoined_after"], rejoin["catch_up_seconds"]), (1.5, 4.0))
+
+if __name__ == "__main__":
+    unittest.main()
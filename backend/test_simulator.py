@@ -0,0 +1,196 @@
+import random
+import unittest
+from response_store import ResponseStore
+from simulator import SimCluster, SimRuntime, random_timeline, simulate
+
+def record_routes(cluster):
+    """Wrap cluster.route so every routed message is also recorded as (virtual time, message)."""
+    sent = []
+    route = cluster.route
+
+    def recording_route(sender, message):
+        sent.append((cluster.runtime.now, message))
+        route(sender, message)
+
+    cluster.route = recording_route
+    return sent
+
+class TestSimRuntime(unittest.TestCase):
+    def test_timeouts_fire_in_virtual_time(self):
+        runtime = SimRuntime(seed=1)
+        event = runtime.Event()
+        results = []
+
+        def waiter():
+            results.append((event.wait(timeout=10.0), runtime.time()))
+
+        def setter():
+            runtime.sleep(25.0)
+            event.set()
+
+        runtime.spawn(waiter)
+        runtime.spawn(setter)
+        runtime.run(until=100.0)
+        runtime.close()
+        self.assertEqual(results, [(False, 10.0)])
+
+class TestSimulator(unittest.TestCase):
+    def test_same_seed_same_run(self):
+        self.assertEqual(simulate(seed=3, duration=60.0), simulate(seed=3, duration=60.0))
+
+    def test_commits_without_faults(self):
+        timeline = [
+            {"at": 1.0, "node": 0, "client": "create 1"},
+            {"at": 5.0, "node": 1, "client": "query 1 hello"},
+            {"at": 20.0, "node": 2, "client": "query 1 again"},
+        ]
+        stats = simulate(seed=0, duration=60.0, timeline=timeline)
+        self.assertEqual(stats["committed"], 3)
+        self.assertFalse(stats["diverged"])
+
+    def test_leader_crash_recovers(self):
+        timeline = [
+            {"at": 1.0, "node": 0, "client": "create 1"},
+            {"at": 15.0, "command": "failNode 0"},
+            {"at": 20.0, "node": 1, "client": "query 1 after crash"},
+        ]
+        stats = simulate(seed=0, duration=120.0, timeline=timeline)
+        self.assertEqual(stats["committed"], 2)
+        self.assertIsNotNone(stats["recovery"][0])
+
+class TestCommitPiggybacking(unittest.TestCase):
+    def setUp(self):
+        self.cluster = SimCluster(seed=0)
+        self.sent = record_routes(self.cluster)
+        self.leader = self.cluster.processes[0]
+
+    def tearDown(self):
+        self.cluster.close()
+
+    def from_leader(self, header):
+        return [(t, message) for t, message in self.sent if message["header"] == header and message["src"] == 0]
+
+    def test_commits_ride_on_the_next_accept_then_an_idle_decide(self):
+        first = self.leader.submit("create 1")
+        second = self.leader.submit("create 2")
+        self.cluster.runtime.run(until=60.0)
+
+        accepts = [message for _, message in self.from_leader("ACCEPT")]
+        self.assertEqual([message.get("commits") for message in accepts[::2]], [None, [[1, f"#rid={first} create 1"]]])
+        decides = self.from_leader("DECIDE")
+        self.assertEqual([message["commits"] for _, message in decides], [[[2, f"#rid={second} create 2"]]] * 2)
+        last_accept_time = max(t for t, _ in self.from_leader("ACCEPT"))
+        self.assertGreaterEqual(decides[0][0], last_accept_time + self.leader.decide_linger)
+        for process in self.cluster.processes.values():
+            self.assertEqual(set(process.service.get_all_contexts()), {"1", "2"})
+
+    def test_commits_are_requeued_when_an_accept_misses_its_majority(self):
+        self.leader.submit("create 1")
+        self.cluster.runtime.run(until=30.0)
+        self.leader.decide_linger = 1000.0 # keep the next commit unannounced
+        second = self.leader.submit("create 2")
+        self.cluster.runtime.run(until=60.0)
+        self.assertEqual(self.leader.unannounced_commits, [[2, f"#rid={second} create 2"]])
+
+        self.cluster.apply("failLink 0 1")
+        self.cluster.apply("failLink 0 2")
+        self.leader.submit("create 3")
+        self.cluster.runtime.run(until=90.0)
+        self.assertEqual(self.leader.unannounced_commits, [[2, f"#rid={second} create 2"]])
+        self.assertNotIn("2", self.cluster.processes[1].service.get_all_contexts())
+
+        self.cluster.apply("fixLink 0 1")
+        self.cluster.apply("fixLink 0 2")
+        self.leader.decide_linger = 0.2
+        self.leader.submit("create 4")
+        self.cluster.runtime.run(until=150.0)
+        for process in self.cluster.processes.values():
+            self.assertEqual(set(process.service.get_all_contexts()), {"1", "2", "4"})
+
+class TestCommitOrder(unittest.TestCase):
+    def setUp(self):
+        self.cluster = SimCluster(seed=0)
+        self.follower = self.cluster.processes[1]
+
+    def tearDown(self):
+        self.cluster.close()
+
+    def deliver(self, at, header, commits):
+        message = {"header": header, "message": commits[-1][1], "ballot_number": [1, 0, 1], "src": 0, "dest": 1,
+                   "context_id": -1, "commit_index": 0, "commits": commits}
+        self.cluster.runtime.call_at(at, lambda: self.cluster.deliver(1, message))
+
+    def test_commits_apply_in_index_order_whatever_the_arrival_order(self):
+        self.deliver(1.0, "DECIDE", [[1, "#rid=0.0:1 create 1"]])
+        self.deliver(2.0, "ACCEPT", [[2, "#rid=0.0:2 query 1 q2"]])
+        # Overtakes the ACCEPT carrying 3 while q2 is still being generated
+        self.deliver(2.5, "DECIDE", [[4, "#rid=0.0:4 query 1 q4"]])
+        self.deliver(3.0, "ACCEPT", [[3, "#rid=0.0:3 query 1 q3"]])
+        self.cluster.runtime.run(until=30.0)
+        self.assertEqual(self.follower.service.get_context("1"), "Query: q2\nQuery: q3\nQuery: q4")
+        self.assertEqual(self.follower.commit_index, 4)
+
+    def test_commits_already_applied_are_ignored(self):
+        self.deliver(1.0, "DECIDE", [[1, "#rid=0.0:1 create 1"], [2, "#rid=0.0:2 query 1 q2"]])
+        self.deliver(10.0, "ACCEPT", [[2, "#rid=0.0:5 query 1 q2"]])
+        self.cluster.runtime.run(until=30.0)
+        self.assertEqual(self.follower.service.get_context("1"), "Query: q2")
+
+class TestChoose(unittest.TestCase):
+    def test_accept_carries_the_reference_and_replicas_fetch_the_text(self):
+        cluster = SimCluster(seed=0)
+        sent = record_routes(cluster)
+        try:
+            cluster.schedule([
+                {"at": 1.0, "node": 0, "client": "create 1"},
+                {"at": 10.0, "node": 2, "client": "query 1 hello"},
+            ])
+            cluster.runtime.run(until=40.0)
+            answer = cluster.processes[1].collected_responses["1"][1]
+            cluster.submit(1, f"choose 1 1 {ResponseStore.digest(answer)}")
+            stats = cluster.run([], 80.0)
+
+            chooses = [(t, message) for t, message in sent if "choose" in message["message"]]
+            self.assertEqual({message["header"] for _, message in chooses if "chosen" in message}, {"FORWARD"})
+            # Node 2 never saw node 1's answer, it asks for it on the ACCEPT rather than on the decide
+            accepted_at = min(t for t, message in chooses if message["header"] == "ACCEPT" and message["dest"] == 2)
+            fetches = [(t, message) for t, message in sent if message["header"] == "FETCH"]
+            self.assertEqual({message["src"] for _, message in fetches}, {2})
+            self.assertLessEqual(fetches[0][0], accepted_at + cluster.network.delay * (1 + cluster.jitter))
+            for process in cluster.processes.values():
+                self.assertTrue(process.service.get_context("1").endswith(f"Answer: {answer}"))
+            self.assertFalse(stats["diverged"])
+        finally:
+            cluster.close()
+
+class TestContextSync(unittest.TestCase):
+    def test_restarted_node_installs_a_snapshot_at_a_commit_index(self):
+        cluster = SimCluster(seed=0)
+        sent = record_routes(cluster)
+        try:
+            stats = cluster.run([
+                {"at": 1.0, "node": 0, "client": "create 1"},
+                {"at": 5.0, "command": "failNode 2"},
+                {"at": 10.0, "node": 0, "client": "create 2"},
+                {"at": 20.0, "command": "restartNode 2"},
+                {"at": 30.0, "node": 0, "client": "create 3"},
+            ], 80.0)
+            self.assertEqual(set(cluster.processes[2].service.get_all_contexts()), {"1", "2", "3"})
+            self.assertEqual([process.commit_index for process in cluster.processes.values()], [3, 3, 3])
+            self.assertFalse(stats["diverged"])
+            snapshots = [message["snapshot"] for _, message in sent if message["header"] == "SYNCDATA"]
+            self.assertEqual(len(snapshots), 1)
+            self.assertGreaterEqual(snapshots[0]["index"], 2)
+            self.assertTrue(all("contexts" not in message for _, message in sent))
+        finally:
+            cluster.close()
+
+class TestConvergence(unittest.TestCase):
+    def test_fault_free_runs_converge(self):
+        for seed in range(30):
+            timeline = random_timeline(random.Random(seed), 3, 200.0, max_faults=0)
+            with self.subTest(seed=seed):
+                self.assertFalse(simulate(seed, duration=200.0, timeline=timeline)["diverged"])
+
+if __name__ == '__main__':
+    unittest.main()